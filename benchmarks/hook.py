@@ -0,0 +1,291 @@
+#!/usr/bin/python
+#
+# Run the whole hook against synthetic repositories
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# Usage: hook.py [SCENARIO...]
+#
+# For each scenario (all of them without arguments) a bare repository is
+# generated with 'git fast-import', and post-receive-email.py is run in it
+# the way git runs it: with the ref update lines on stdin. The mails go to
+# an SMTP server running in this process. Printed for each scenario:
+#
+#   wall      time the hook took
+#   git       number of git commands it ran, counted by a wrapper script
+#             put first in its PATH (which adds a little to the wall time)
+#   mails     number of mails received
+#   bytes     total size of the mails received
+#   peak RSS  largest resident set of the hook or any process it waited for
+#
+# The repositories are created in a temporary directory that is removed
+# afterwards, unless BENCHMARK_KEEP is set in the environment.
+
+import asyncore
+import os
+import shutil
+import smtpd
+import sys
+import tempfile
+import threading
+import time
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE, check_call, check_output
+
+HOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'post-receive-email.py')
+
+# Counts what arrives, throws the mails away
+class SinkServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.mails = 0
+        self.bytes = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.mails += 1
+        self.bytes += len(data)
+
+# Writes a 'git fast-import' stream. Commits are identified by their marks
+# until close() returns the mark => id mapping.
+class FastImport:
+    def __init__(self, git_dir):
+        self.marks_file = os.path.join(git_dir, 'benchmark-marks')
+        self.process = Popen(['git', '--git-dir=' + git_dir, 'fast-import', '--quiet',
+                              '--export-marks=' + self.marks_file],
+                             stdin=PIPE)
+        self.out = self.process.stdin
+        self.mark = 0
+        self.time = 1577836800
+
+    def _data(self, data):
+        self.out.write("data %d\n%s\n" % (len(data), data))
+
+    def commit(self, ref, message, files={}, parents=[]):
+        self.mark += 1
+        self.time += 60
+        self.out.write("commit %s\nmark :%d\n" % (ref, self.mark))
+        self.out.write("author Some Developer <dev@example.com> %d +0000\n" % self.time)
+        self.out.write("committer Some Developer <dev@example.com> %d +0000\n" % self.time)
+        self._data(message)
+        if parents:
+            self.out.write("from :%d\n" % parents[0])
+            for parent in parents[1:]:
+                self.out.write("merge :%d\n" % parent)
+        for path, contents in sorted(files.iteritems()):
+            self.out.write("M 100644 inline %s\n" % path)
+            self._data(contents)
+        self.out.write("\n")
+        return self.mark
+
+    def reset(self, ref, mark):
+        self.out.write("reset %s\nfrom :%d\n\n" % (ref, mark))
+
+    def tag(self, name, mark, message):
+        self.time += 60
+        self.out.write("tag %s\nfrom :%d\n" % (name, mark))
+        self.out.write("tagger Release Manager <release@example.com> %d +0000\n" % self.time)
+        self._data(message)
+
+    def close(self):
+        self.out.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("git fast-import failed")
+        marks = {}
+        for line in open(self.marks_file):
+            mark, id = line.split()
+            marks[int(mark[1:])] = id
+        os.unlink(self.marks_file)
+        return marks
+
+# A 200 line source file, with one line different in each revision
+def source_file(n, revision):
+    lines = ["/* file %d, line %d */ int f%d_%d(int x) { return x + %d; }" % (n, i, n, i, i)
+             for i in xrange(200)]
+    lines[revision % 200] = "/* file %d, revision %d */ int changed_%d = %d;" % (n, revision, revision, revision)
+    return "\n".join(lines) + "\n"
+
+def initial_files():
+    files = {'README': "A synthetic repository\n"}
+    for n in xrange(50):
+        files['src/file%d.c' % n] = source_file(n, 0)
+    return files
+
+# The scenarios each build a repository and return the ref update lines
+# for the push, as (old, new, refname); old and new are marks, None for a
+# created ref, or a ref name.
+
+# 500 new commits on master
+def fast_forward(fi):
+    base = fi.commit('refs/heads/master', "Initial import\n", initial_files())
+    tip = base
+    for i in xrange(1, 501):
+        tip = fi.commit('refs/heads/master', "Change number %d\n\nSome explanation.\n" % i,
+                        {'src/file%d.c' % (i % 50): source_file(i % 50, i)}, [tip])
+    return [(base, tip, 'refs/heads/master')]
+
+# A 300 commit topic branch that was never pushed, merged into master
+def merge_long_branch(fi):
+    base = fi.commit('refs/heads/master', "Initial import\n", initial_files())
+    master = base
+    for i in xrange(1, 21):
+        master = fi.commit('refs/heads/master', "Mainline change %d\n" % i,
+                           {'src/file%d.c' % (i % 25): source_file(i % 25, i)}, [master])
+    topic = base
+    topic_files = {}
+    for i in xrange(1, 301):
+        path = 'src/file%d.c' % (25 + i % 25)
+        topic_files[path] = source_file(25 + i % 25, i)
+        topic = fi.commit('refs/heads/topic', "Topic change %d\n" % i, {path: topic_files[path]}, [topic])
+    merge = fi.commit('refs/heads/master', "Merge branch 'topic'\n", topic_files, [master, topic])
+    # The topic branch was only local
+    fi.out.write("reset refs/heads/topic\nfrom 0000000000000000000000000000000000000000\n\n")
+    return [(master, merge, 'refs/heads/master')]
+
+# One new commit in a repository with 20000 branches
+def many_branches(fi):
+    base = fi.commit('refs/heads/master', "Initial import\n", initial_files())
+    history = [base]
+    for i in xrange(1, 201):
+        history.append(fi.commit('refs/heads/master', "Change number %d\n" % i,
+                                 {'src/file%d.c' % (i % 50): source_file(i % 50, i)}, [history[-1]]))
+    for i in xrange(20000):
+        fi.reset('refs/heads/branch-%05d' % i, history[i % len(history)])
+    tip = fi.commit('refs/heads/master', "One more change\n",
+                    {'src/file0.c': source_file(0, 1000)}, [history[-1]])
+    return [(history[-1], tip, 'refs/heads/master')]
+
+# One commit adding a 50 MB file
+def huge_diff(fi):
+    base = fi.commit('refs/heads/master', "Initial import\n", initial_files())
+    line = "%08d some generated data that nobody is going to read in a mail\n"
+    data = "".join([line % i for i in xrange(50 * 1024 * 1024 / len(line % 0))])
+    tip = fi.commit('refs/heads/master', "Add generated data\n",
+                    {'data/generated.txt': data, 'src/file0.c': source_file(0, 1)}, [base])
+    return [(base, tip, 'refs/heads/master')]
+
+# An annotated tag on 20000 commits of untagged history. (The root commit is
+# tagged, since without an earlier tag the hook runs a 'git diff REV' that
+# fails in a bare repository.)
+def deep_tag(fi):
+    tip = fi.commit('refs/heads/master', "Initial import\n", initial_files())
+    fi.tag('v0.0', tip, "The beginning\n")
+    for i in xrange(1, 20000):
+        tip = fi.commit('refs/heads/master', "Change number %d\n" % i,
+                        {'src/file%d.c' % (i % 50): source_file(i % 50, i)}, [tip])
+    fi.tag('v1.0', tip, "Version 1.0\n")
+    return [(None, 'refs/tags/v1.0', 'refs/tags/v1.0')]
+
+SCENARIOS = [
+    ('fast-forward', fast_forward),
+    ('merge-long-branch', merge_long_branch),
+    ('many-branches', many_branches),
+    ('huge-diff', huge_diff),
+    ('deep-tag', deep_tag),
+]
+
+def create_repository(git_dir, scenario, port):
+    check_call(['git', 'init', '--quiet', '--bare', git_dir])
+    fi = FastImport(git_dir)
+    updates = scenario(fi)
+    marks = fi.close()
+
+    def resolve(rev):
+        if rev is None:
+            return "0" * 40
+        elif isinstance(rev, int):
+            return marks[rev]
+        else:
+            return check_output(['git', '--git-dir=' + git_dir, 'rev-parse', rev]).strip()
+
+    for key, value in [('hooks.mailinglist', 'list@example.com'),
+                       ('hooks.smtp-host', '127.0.0.1'),
+                       ('hooks.smtp-port', str(port)),
+                       ('hooks.smtp-fallback-mail', 'example.com'),
+                       ('hooks.smtp-sender', 'hook@example.com')]:
+        check_call(['git', '--git-dir=' + git_dir, 'config', key, value])
+
+    return "".join(["%s %s %s\n" % (resolve(old), resolve(new), refname)
+                    for old, new, refname in updates])
+
+# A 'git' that logs each time it is run, put in front of the real one
+def create_git_wrapper(bin_dir, log):
+    os.mkdir(bin_dir)
+    wrapper = os.path.join(bin_dir, 'git')
+    f = open(wrapper, 'w')
+    f.write('#!/bin/sh\necho >> "%s"\nexec "%s" "$@"\n' % (log, find_executable('git')))
+    f.close()
+    os.chmod(wrapper, 0755)
+
+def run_hook(git_dir, stdin, bin_dir):
+    env = dict(os.environ)
+    env['GIT_DIR'] = git_dir
+    env['PATH'] = bin_dir + os.pathsep + env['PATH']
+
+    start = time.time()
+    process = Popen([sys.executable, HOOK], stdin=PIPE, env=env, cwd=git_dir)
+    process.stdin.write(stdin)
+    process.stdin.close()
+    # wait4() rather than wait(), for the resource usage
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = status
+    elapsed = time.time() - start
+
+    if status != 0:
+        raise RuntimeError("the hook failed")
+    return elapsed, rusage.ru_maxrss
+
+def main():
+    names = [name for name, scenario in SCENARIOS]
+    for arg in sys.argv[1:]:
+        if arg not in names:
+            print >>sys.stderr, "Unknown scenario '%s'; the scenarios are: %s" % (arg, " ".join(names))
+            sys.exit(1)
+    scenarios = [(name, scenario) for name, scenario in SCENARIOS
+                 if len(sys.argv) < 2 or name in sys.argv[1:]]
+
+    server = SinkServer()
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+
+    work_dir = tempfile.mkdtemp(prefix='email-hook-benchmark-')
+    git_log = os.path.join(work_dir, 'git.log')
+    bin_dir = os.path.join(work_dir, 'bin')
+    create_git_wrapper(bin_dir, git_log)
+
+    try:
+        print "%-20s %9s %6s %6s %12s %10s" % ("scenario", "wall", "git", "mails", "bytes", "peak RSS")
+        for name, scenario in scenarios:
+            git_dir = os.path.join(work_dir, name + '.git')
+            stdin = create_repository(git_dir, scenario, server.port)
+
+            open(git_log, 'w').close()
+            mails, bytes = server.mails, server.bytes
+            elapsed, max_rss = run_hook(git_dir, stdin, bin_dir)
+            git_count = len(open(git_log).readlines())
+
+            print "%-20s %8.2fs %6d %6d %12d %8.1fMB" % (name, elapsed, git_count,
+                                                        server.mails - mails, server.bytes - bytes,
+                                                        max_rss / 1024.)
+            sys.stdout.flush()
+    finally:
+        if os.environ.get('BENCHMARK_KEEP'):
+            print "Repositories left in", work_dir
+        else:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Compare the builtin diff to HTML formatter with the Pygments one
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# Usage: html_renderer.py [FILE...]
+#
+# Formats each FILE (or, without arguments, synthetic diffs of a few sizes)
+# with both renderers, checks that the markup is the same and prints the
+# time each one took.
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diffhtml import format_diff_html
+from pygments import highlight
+from pygments.lexers import DiffLexer
+from pygments.formatters import HtmlFormatter
+
+def format_pygments(body):
+    return highlight(body, DiffLexer(encoding='latin1'), HtmlFormatter(encoding='latin1', full=True, noclasses=True, nobackground=True))
+
+# Everything from the <pre> on; the document heads differ on purpose
+def markup(html):
+    return html[html.index('<div class="highlight">'):]
+
+def make_diff(size):
+    rand = random.Random(size)
+    lines = ["commit %040x" % rand.getrandbits(160),
+             "Author: Some One <someone@example.com>",
+             "Date:   Wed Jan 1 00:00:00 2020 +0000",
+             "",
+             "    Change some <things> & \"stuff\"",
+             "",
+             "---"]
+    length = 0
+    n = 0
+    while length < size:
+        n += 1
+        lines += ["diff --git a/file%d.c b/file%d.c" % (n, n),
+                  "index 1234567..89abcde 100644",
+                  "--- a/file%d.c" % n,
+                  "+++ b/file%d.c" % n,
+                  "@@ -1,40 +1,40 @@ int main(int argc, char **argv)"]
+        for i in xrange(40):
+            prefix = rand.choice(" +-")
+            lines.append(prefix + "    if (x[%d] < y && z > 0) { return \"%d\"; }" % (i, rand.getrandbits(32)))
+        length = sum([len(line) + 1 for line in lines])
+    return "\n".join(lines) + "\n"
+
+def time_it(f, body):
+    best = None
+    for i in xrange(3):
+        start = time.time()
+        result = f(body)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    if len(sys.argv) > 1:
+        cases = [(name, open(name).read()) for name in sys.argv[1:]]
+    else:
+        cases = [("%d kB" % (size / 1024), make_diff(size))
+                 for size in (10*1024, 100*1024, 1024*1024, 5*1024*1024)]
+
+    print "%-20s %12s %12s %8s  %s" % ("input", "pygments", "builtin", "speedup", "same")
+    for name, body in cases:
+        pygments_time, pygments_html = time_it(format_pygments, body)
+        builtin_time, builtin_html = time_it(format_diff_html, body)
+        same = markup(pygments_html) == markup(builtin_html)
+        print "%-20s %11.3fs %11.3fs %7.1fx  %s" % (name, pygments_time, builtin_time,
+                                                   pygments_time / max(builtin_time, 1e-6),
+                                                   same and "yes" or "NO")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Fast HTML formatting of diffs for the email hook
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# Pygments' DiffLexer does nothing more than look at the first characters of
+# each line, so we can produce the same markup as
+#
+#   highlight(body, DiffLexer(encoding='latin1'),
+#             HtmlFormatter(encoding='latin1', full=True, noclasses=True, nobackground=True))
+#
+# with a single pass over the lines. The only difference is that the
+# (unused, since all styles are inline) style sheet and the Pygments banner
+# comment are left out of the document head.
+#
+# The body is handled as bytes throughout, which is what the latin1
+# decode/encode round trip above amounts to, so there is no way for this to
+# fail on an unexpected encoding.
+
+DOC_HEADER = """\
+<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN"
+   "http://www.w3.org/TR/html4/strict.dtd">
+<html>
+<head>
+  <title></title>
+  <meta http-equiv="content-type" content="text/html; charset=latin1">
+</head>
+<body>
+<h2></h2>
+
+<div class="highlight"><pre style="line-height: 125%"><span></span>"""
+
+DOC_FOOTER = """\
+</pre></div>
+</body>
+</html>
+"""
+
+# The inline styles of Pygments' default style for each kind of line
+_INSERTED = '<span style="color: #00A000">'
+_DELETED = '<span style="color: #A00000">'
+_STRONG = '<span style="font-weight: bold">'
+_SUBHEADING = '<span style="color: #800080; font-weight: bold">'
+_HEADING = '<span style="color: #000080; font-weight: bold">'
+
+# Line prefix => span it starts; anything else is plain text
+_LINE_STARTS = {
+    '+': _INSERTED,
+    '-': _DELETED,
+    '!': _STRONG,
+    '@': _SUBHEADING,
+    '=': _HEADING,
+}
+
+def format_diff_html(body):
+    # Same preprocessing as the Pygments lexer
+    text = body.replace('\r\n', '\n').replace('\r', '\n').strip('\n')
+
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;') \
+               .replace('"', '&quot;').replace("'", '&#39;')
+
+    result = []
+    append = result.append
+    get_start = _LINE_STARTS.get
+    for line in text.split('\n'):
+        first = line[:1]
+        start = get_start(first)
+        if start is None and first in ('d', 'i', 'I'):
+            if line.startswith('diff') or line.startswith('index') or line.startswith('Index'):
+                start = _HEADING
+        if start is None:
+            append(line)
+        else:
+            append(start + line + '</span>')
+
+    return DOC_HEADER + '\n'.join(result) + '\n' + DOC_FOOTER
@@ -19,13 +19,20 @@
 #
 # (These are adapted from git-bz)
 
+import atexit
 import os
 import re
 from subprocess import Popen, PIPE
 import sys
 import pwd
+import threading
+import time
+
+# Imported when the persistent commit cache is opened
+sqlite3 = None
 
 from util import die
+import tracing
 
 # Clone of subprocess.CalledProcessError (not in Python 2.4)
 class CalledProcessError(Exception):
@@ -38,6 +45,41 @@ class CalledProcessError(Exception):
 
 NULL_REVISION = "0000000000000000000000000000000000000000"
 
+# When the run has to be finished (a time.time() value), or None for no limit
+deadline = None
+# Even past the deadline, give an operation this many seconds
+MIN_TIMEOUT = 10
+
+def set_deadline(when):
+    global deadline
+    deadline = when
+
+# How many seconds an operation started now may take, or None for no limit
+def get_timeout():
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), MIN_TIMEOUT)
+
+def _kill(process):
+    process.timed_out = True
+    try:
+        process.kill()
+    except OSError:
+        # Already gone
+        pass
+
+# Kill the process if it is still running when get_timeout() runs out. Returns
+# a timer to cancel() once it is done, or None if there is no deadline.
+def _watch(process):
+    process.timed_out = False
+    timeout = get_timeout()
+    if timeout is None:
+        return None
+    timer = threading.Timer(timeout, _kill, [process])
+    timer.daemon = True
+    timer.start()
+    return timer
+
 # Run a git command
 #    Non-keyword arguments are passed verbatim as command line arguments
 #    Keyword arguments are turned into command line options
@@ -98,9 +140,14 @@ def git_run(command, *args, **kwargs):
     else:
         stdin = None
 
+    start = time.time()
     process = Popen(to_run,
                     stdout=stdout, stderr=stderr, stdin=stdin)
+    timer = _watch(process)
     output, error = process.communicate(input)
+    if timer is not None:
+        timer.cancel()
+    tracing.git_command(to_run, time.time() - start, len(output or ""), process.returncode)
     if process.returncode != 0:
         if not quiet and not interactive:
             print >>sys.stderr, error,
@@ -124,45 +171,386 @@ class Git:
 
 git = Git()
 
+# Long-lived reader for the object database. Rather than forking a new
+# 'git cat-file' for every object we look at, we keep one
+# 'git cat-file --batch' and one 'git cat-file --batch-check' process around
+# for the duration of the hook and feed them object names on stdin.
+#
+# The daemon handles pushes to several repositories; it keeps the processes
+# of the ones it isn't working on in 'idle' (git_dir => (batch, batch_check))
+class ObjectReader:
+    def __init__(self):
+        self.batch = None
+        self.batch_check = None
+        self.git_dir = None
+        self.idle = {}
+
+    def _start(self, option):
+        process = Popen(['git', 'cat-file', option],
+                        stdin=PIPE, stdout=PIPE, bufsize=-1)
+        # For tracing
+        process.option = option
+        process.start_time = time.time()
+        process.requests = 0
+        process.stdout_bytes = 0
+        return process
+
+    def _query(self, process, option, rev):
+        process.stdin.write(rev + "\n")
+        process.stdin.flush()
+        header = process.stdout.readline()
+        process.requests += 1
+        process.stdout_bytes += len(header)
+        if not header:
+            raise CalledProcessError(process.poll() or 128, "git cat-file " + option)
+        fields = header.split()
+        if len(fields) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            raise CalledProcessError(128, "git cat-file %s %s" % (option, rev))
+        return fields[0], fields[1], int(fields[2])
+
+    # Return (id, type, size) for the given revision
+    def info(self, rev):
+        if self.batch_check is None:
+            self.batch_check = self._start('--batch-check')
+        return self._query(self.batch_check, '--batch-check', rev)
+
+    # Return (id, type, contents) for the given revision
+    def read(self, rev):
+        if self.batch is None:
+            self.batch = self._start('--batch')
+        id, type, size = self._query(self.batch, '--batch', rev)
+        contents = self.batch.stdout.read(size + 1)[:size]
+        self.batch.stdout_bytes += size + 1
+        return id, type, contents
+
+    # Forget about the processes; used in a child after fork() so that it
+    # starts its own rather than interleaving requests with the parent
+    def detach(self):
+        self.batch = None
+        self.batch_check = None
+        self.idle = {}
+
+    def _close(self, processes):
+        for process in processes:
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+                # One record for everything the process did
+                tracing.git_command(['git', 'cat-file', process.option],
+                                    time.time() - process.start_time, process.stdout_bytes,
+                                    process.returncode, requests=process.requests)
+
+    # Switch to the processes for the repository at git_dir (which must be
+    # $GIT_DIR by now), keeping the current ones for later
+    def use_repository(self, git_dir):
+        if git_dir == self.git_dir:
+            return
+
+        if self.git_dir is not None:
+            self.idle[self.git_dir] = (self.batch, self.batch_check)
+        self.batch, self.batch_check = self.idle.pop(git_dir, (None, None))
+        self.git_dir = git_dir
+
+        # The repository may have gone away since
+        for process in (self.batch, self.batch_check):
+            if process is not None and process.poll() is not None:
+                self._close((self.batch, self.batch_check))
+                self.batch = None
+                self.batch_check = None
+                break
+
+        while len(self.idle) > MAX_IDLE_REPOSITORIES:
+            self._close(self.idle.popitem()[1])
+
+    def close(self):
+        self._close((self.batch, self.batch_check))
+        self.batch = None
+        self.batch_check = None
+        for processes in self.idle.values():
+            self._close(processes)
+        self.idle = {}
+
+# How many repositories the daemon keeps cat-file processes for
+MAX_IDLE_REPOSITORIES = 20
+
+object_reader = ObjectReader()
+atexit.register(object_reader.close)
+
+# Split a raw commit object into a list of (key, value) headers and the message
+def parse_commit_object(contents):
+    headers, _, message = contents.partition("\n\n")
+    result = []
+    for line in headers.split("\n"):
+        if line.startswith(" ") and result:
+            # Continuation line (mergetag, gpgsig)
+            key, value = result[-1]
+            result[-1] = (key, value + "\n" + line[1:])
+        else:
+            key, _, value = line.partition(" ")
+            result.append((key, value))
+    return result, message
+
 class GitCommit:
-    def __init__(self, id, subject):
+    def __init__(self, id, subject, author=None, parents=None, side=None):
         self.id = id
         self.subject = subject
+        # 'Name <email>'
+        self.author = author
+        # List of parent IDs, or None if not known
+        self.parents = parents
+        # '<' or '>' when listed with left_right=True
+        self.side = side
+
+# Commits are immutable, so everything we load is remembered here by ID
+commit_cache = {}
 
-# Takes argument like 'git.rev_list()' and returns a list of commit objects
+# Takes argument like 'git.rev_list()' and returns a list of commit objects.
+# With parents=True the parents of each commit are filled in, and with
+# left_right=True which side of a symmetric difference (A...B) it is on.
 def rev_list_commits(*args, **kwargs):
+    if persistent_commit_cache is not None:
+        return _rev_list_commits_cached(*args, **kwargs)
+
     kwargs_copy = dict(kwargs)
-    kwargs_copy['pretty'] = 'format:%s'
+    kwargs_copy['pretty'] = 'format:%an <%ae>%n%s'
     kwargs_copy['_split_lines'] = True
     lines = git.rev_list(*args, **kwargs_copy)
-    if (len(lines) % 2 != 0):
-        raise RuntimeError("git rev-list didn't return an even number of lines")
+    if (len(lines) % 3 != 0):
+        raise RuntimeError("git rev-list didn't return a multiple of three lines")
+
+    with_parents = kwargs.get('parents', False)
 
     result = []
-    for i in xrange(0, len(lines), 2):
-        m = re.match("commit\s+([A-Fa-f0-9]+)", lines[i])
+    for i in xrange(0, len(lines), 3):
+        m = re.match(r"commit\s+([<>-]?)([A-Fa-f0-9]+)((?:\s+[A-Fa-f0-9]+)*)\s*$", lines[i])
         if not m:
             raise RuntimeError("Can't parse commit it '%s'", lines[i])
-        commit_id = m.group(1)
-        subject = lines[i + 1]
-        result.append(GitCommit(commit_id, subject))
+        commit_id = m.group(2)
+        side = m.group(1) or None
+        if with_parents:
+            parents = m.group(3).split()
+        else:
+            parents = None
+        author = lines[i + 1]
+        subject = lines[i + 2]
+
+        cached = commit_cache.get(commit_id)
+        if cached is not None and parents is None:
+            parents = cached.parents
+
+        commit = GitCommit(commit_id, subject, author, parents, side)
+        commit_cache[commit_id] = commit
+        result.append(commit)
+
+    return result
+
+# Optional cache of commit metadata in an SQLite database, kept between
+# runs of the hook. Since commits are immutable it can be shared by any
+# number of repositories, such as all the forks of a project. Once it holds
+# more than max_entries commits, the least recently used are dropped.
+class PersistentCommitCache:
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS commits ("
+                        "id TEXT PRIMARY KEY, subject TEXT, author TEXT, parents TEXT, used INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS commits_used ON commits (used)")
+        self.db.commit()
+
+    # Returns a dictionary of ID => GitCommit for the IDs that are cached
+    def lookup(self, ids):
+        result = {}
+        ids = list(ids)
+        # Stay under SQLite's limit of 999 parameters per statement
+        for i in xrange(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.db.execute("SELECT id, subject, author, parents FROM commits WHERE id IN (%s)" %
+                                   ",".join(["?"] * len(chunk)), chunk)
+            for id, subject, author, parents in rows:
+                if parents is not None:
+                    parents = parents.split()
+                result[id] = GitCommit(id, subject, author, parents)
+
+        if result:
+            now = int(time.time())
+            self.db.executemany("UPDATE commits SET used = ? WHERE id = ?",
+                                [(now, id) for id in result])
+            self.db.commit()
+
+        return result
+
+    def store(self, commits):
+        now = int(time.time())
+        rows = []
+        for commit in commits:
+            if commit.parents is not None:
+                parents = " ".join(commit.parents)
+            else:
+                parents = None
+            rows.append((commit.id, commit.subject, commit.author, parents, commit.id, now))
+        self.db.executemany("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, "
+                            "COALESCE(?, (SELECT parents FROM commits WHERE id = ?)), ?)", rows)
+
+        count = self.db.execute("SELECT COUNT(*) FROM commits").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("DELETE FROM commits WHERE id IN "
+                            "(SELECT id FROM commits ORDER BY used LIMIT ?)",
+                            (count - self.max_entries,))
+        self.db.commit()
+
+persistent_commit_cache = None
+
+# Start using the persistent commit cache at 'path'; problems with it are
+# reported but not fatal, we just go without.
+def open_persistent_commit_cache(path, max_entries=None):
+    global persistent_commit_cache
+    global sqlite3
+
+    try:
+        import sqlite3
+    except ImportError:
+        print >>sys.stderr, "Python has no sqlite3 module; not using the commit cache"
+        return
+
+    try:
+        if max_entries is None:
+            persistent_commit_cache = PersistentCommitCache(path)
+        else:
+            persistent_commit_cache = PersistentCommitCache(path, max_entries)
+    except sqlite3.Error, e:
+        print >>sys.stderr, "Can't open commit cache %s: %s" % (path, e)
+
+def _lookup_persistent(ids):
+    global persistent_commit_cache
+
+    try:
+        return persistent_commit_cache.lookup(ids)
+    except sqlite3.Error, e:
+        print >>sys.stderr, "Commit cache lookup failed, not using it: %s" % e
+        persistent_commit_cache = None
+        return {}
+
+def _store_persistent(commits):
+    global persistent_commit_cache
+
+    if persistent_commit_cache is None:
+        return
+    try:
+        persistent_commit_cache.store(commits)
+    except sqlite3.Error, e:
+        print >>sys.stderr, "Commit cache update failed, not using it: %s" % e
+        persistent_commit_cache = None
+
+# rev_list_commits() when there is a persistent cache: list only the IDs
+# (and parents) and get the rest from the cache, asking git only for the
+# commits it doesn't have yet.
+def _rev_list_commits_cached(*args, **kwargs):
+    kwargs_copy = dict(kwargs)
+    kwargs_copy['_split_lines'] = True
+    lines = git.rev_list(*args, **kwargs_copy)
+
+    with_parents = kwargs.get('parents', False)
+
+    listed = []
+    for line in lines:
+        m = re.match(r"([<>-]?)([A-Fa-f0-9]+)((?:\s+[A-Fa-f0-9]+)*)\s*$", line)
+        if not m:
+            raise RuntimeError("Can't parse commit it '%s'", line)
+        if with_parents:
+            parents = m.group(3).split()
+        else:
+            parents = None
+        listed.append((m.group(2), parents, m.group(1) or None))
+
+    known = _lookup_persistent([id for (id, parents, side) in listed])
+
+    missing = [id for (id, parents, side) in listed if id not in known]
+    if missing:
+        input = "".join([id + "\n" for id in missing])
+        lines = git.log(no_walk='unsorted', stdin=True, pretty='format:%H %P%n%an <%ae>%n%s',
+                        _input=input, _split_lines=True)
+        if (len(lines) % 3 != 0):
+            raise RuntimeError("git log didn't return a multiple of three lines")
+
+        fetched = []
+        for i in xrange(0, len(lines), 3):
+            ids = lines[i].split()
+            fetched.append(GitCommit(ids[0], lines[i + 2], lines[i + 1], ids[1:]))
+        _store_persistent(fetched)
+        for commit in fetched:
+            known[commit.id] = commit
+
+    result = []
+    for id, parents, side in listed:
+        cached = known[id]
+        if parents is None:
+            parents = cached.parents
+        commit = GitCommit(id, cached.subject, cached.author, parents, side)
+        commit_cache[id] = commit
+        result.append(commit)
 
     return result
 
 # Loads a single commit object by ID
 def load_commit(commit_id):
-    return rev_list_commits(commit_id + "^!")[0]
+    if commit_id in commit_cache:
+        return commit_cache[commit_id]
+
+    if persistent_commit_cache is not None and re.match(r"^[0-9a-f]{40}$", commit_id):
+        commit = _lookup_persistent([commit_id]).get(commit_id)
+        if commit is not None:
+            commit_cache[commit_id] = commit
+            return commit
+
+    id, type, contents = object_reader.read(commit_id + "^{commit}")
+    if id in commit_cache:
+        commit_cache[commit_id] = commit_cache[id]
+        return commit_cache[id]
+
+    headers, message = parse_commit_object(contents)
+    author = None
+    parents = []
+    for key, value in headers:
+        if key == 'encoding' and value.lower() not in ('utf-8', 'utf8'):
+            # Let git do the reencoding for us
+            return rev_list_commits(id + "^!")[0]
+        if key == 'author':
+            m = re.match(r"(.*?)\s*(<[^>]*>)", value)
+            if m:
+                author = m.group(1) + " " + m.group(2)
+        if key == 'parent':
+            parents.append(value)
+
+    # Same as %s: the first paragraph of the message, joined into one line
+    subject_lines = []
+    for line in message.lstrip("\n").split("\n"):
+        line = line.rstrip()
+        if line == "":
+            break
+        subject_lines.append(line)
+
+    commit = GitCommit(id, " ".join(subject_lines), author, parents)
+    commit_cache[id] = commit
+    commit_cache[commit_id] = commit
+    _store_persistent([commit])
+    return commit
 
 # Return True if the commit has multiple parents
 def commit_is_merge(commit):
     if isinstance(commit, basestring):
-        commit = load_commit(commit)
+        commit_id = commit
+    else:
+        if commit.parents is not None:
+            return len(commit.parents) > 1
+        commit_id = commit.id
 
+    id, type, contents = object_reader.read(commit_id)
+    headers, message = parse_commit_object(contents)
     parent_count = 0
-    for line in git.cat_file("commit", commit.id, _split_lines=True):
-        if line == "":
-            break
-        if line.startswith("parent "):
+    for key, value in headers:
+        if key == "parent":
             parent_count += 1
 
     return parent_count > 1
@@ -174,13 +562,534 @@ def commit_oneline(commit):
 
     return commit.id[0:7] + "... " + commit.subject[0:59]
 
+# Lines longer than this are read from git in pieces
+MAX_READ_SIZE = 64*1024
+# Output that is thrown away is read in blocks this big
+SKIP_READ_SIZE = 1024*1024
+
+_DIFF_HEADERS = ("diff --git ", "diff --cc ", "diff --combined ")
+
+def _is_diff_header(line):
+    return line.startswith(_DIFF_HEADERS)
+
+# Reads the output of 'git log' line by line, or, for the parts nobody is
+# going to look at, in big blocks that are only searched for the line
+# where things get interesting again
+class _LogReader:
+    def __init__(self, f):
+        self.f = f
+        # What skip_to() read past the line it stopped at
+        self.pending = ""
+        # How much has been read from f
+        self.bytes = 0
+
+    # Like f.readline(MAX_READ_SIZE)
+    def readline(self):
+        if not self.pending:
+            piece = self.f.readline(MAX_READ_SIZE)
+            self.bytes += len(piece)
+            return piece
+
+        end = self.pending.find("\n", 0, MAX_READ_SIZE)
+        if end < 0 and len(self.pending) < MAX_READ_SIZE:
+            # The rest of the line is still in f
+            rest = self.f.readline(MAX_READ_SIZE - len(self.pending))
+            self.bytes += len(rest)
+            piece = self.pending + rest
+            self.pending = ""
+            return piece
+
+        if end < 0:
+            end = MAX_READ_SIZE
+        else:
+            end += 1
+        piece = self.pending[:end]
+        self.pending = self.pending[end:]
+        return piece
+
+    # Skip ahead, from the start of a line, to the next line that starts
+    # with one of 'prefixes'
+    def skip_to(self, prefixes):
+        markers = ["\n" + prefix for prefix in prefixes]
+        longest = max([len(marker) for marker in markers])
+        data = "\n" + self.pending
+        self.pending = ""
+        while True:
+            found = [i for i in [data.find(marker) for marker in markers] if i >= 0]
+            if found:
+                self.pending = data[min(found) + 1:]
+                return
+            block = self.f.read(SKIP_READ_SIZE)
+            if not block:
+                return
+            self.bytes += len(block)
+            # A marker may be split between two blocks
+            data = data[-longest:] + block
+
+# Splits the 'git log -p --stat' output for one commit into what
+# 'git show --stat' and 'git show -p --pretty=format:---' would print,
+# leaving deleted files out of the patch. The output is fed in as it is
+# read; once the patch has reached max_patch_size, the diffs of further
+# files are skipped whole and only counted.
+class _LogOutputSplitter:
+    def __init__(self, max_patch_size=None):
+        self.max_patch_size = max_patch_size
+        self.summary = []
+        self.patch = []
+        self.patch_size = 0
+        self.omitted_files = 0
+        self.section = None
+        self.merge = False
+
+    def _flush_section(self):
+        if self.section is None or self.section_deleted:
+            pass
+        elif self.section_omitted:
+            self.omitted_files += 1
+        else:
+            self.patch.extend(self.section)
+            self.patch_size += self.section_size
+        self.section = None
+
+    # 'line_start' is False for the second and later pieces of a long line
+    def feed(self, piece, line_start=True):
+        if line_start and _is_diff_header(piece):
+            self._flush_section()
+            self.section = []
+            self.section_size = 0
+            self.section_in_header = True
+            self.section_deleted = False
+            self.section_omitted = False
+        elif self.section is None:
+            if line_start and piece == "---\n":
+                # log puts this between the message and the stat, show doesn't
+                self.summary.append("\n")
+            else:
+                if line_start and len(self.summary) == 1 and piece.startswith("Merge: "):
+                    self.merge = True
+                self.summary.append(piece)
+            return
+
+        if self.section_in_header and line_start:
+            if piece.startswith("deleted file mode "):
+                self.section_deleted = True
+            elif piece.startswith("@@") or piece.startswith("--- ") or piece.startswith("Binary files "):
+                self.section_in_header = False
+
+        if self.section_omitted or self.section_deleted:
+            return
+
+        self.section_size += len(piece)
+        if self.max_patch_size is not None and self.patch_size + self.section_size > self.max_patch_size:
+            self.section_omitted = True
+            self.section = []
+        else:
+            self.section.append(piece)
+
+    # Whether the rest of the current file diff is going to be dropped. (An
+    # omitted one only once its header has said it isn't a deletion, which
+    # isn't counted.)
+    def skipping(self):
+        return self.section is not None and (self.section_deleted or
+                                             (self.section_omitted and not self.section_in_header))
+
+    def finish(self):
+        self._flush_section()
+        # Like 'git show' with a --diff-filter, nothing at all when no file
+        # diff is left, except for a merge
+        patch = "".join(self.patch)
+        if patch or self.merge:
+            patch = "---\n" + patch
+        return ("".join(self.summary).strip(), patch.strip(), self.omitted_files)
+
+# A 'git log --numstat' line; binary files have '-' for the counts
+_NUMSTAT_RE = re.compile(r"(-|\d+)\t(-|\d+)\t(.*)$")
+
+def _unquote_path(path):
+    if path.startswith('"') and path.endswith('"'):
+        return path[1:-1].decode('string_escape')
+    return path
+
+# The (old, new) paths a --numstat line is about; they differ for a
+# rename, which git writes as 'old => new' or as 'prefix{old => new}suffix'
+def _numstat_paths(field):
+    m = re.match(r"([^\"]*)\{(.*) => (.*)\}(.*)$", field)
+    if m:
+        prefix, old, new, suffix = m.groups()
+        # 'a/{b => }/c' is a rename to 'a/c', and 'a/{ => b}/c' one from it
+        return ((old and prefix + old + suffix) or prefix + suffix[1:],
+                (new and prefix + new + suffix) or prefix + suffix[1:])
+    if " => " in field:
+        old, new = field.split(" => ", 1)
+        return _unquote_path(old), _unquote_path(new)
+    return _unquote_path(field), _unquote_path(field)
+
+# The cheap first pass of show_commits() when some diffs are left out: the
+# 'git show --stat' summary of each commit, the set of paths whose diff has
+# more than max_file_lines added and removed lines, and the set of all the
+# paths it changes. No patch text is generated.
+def _stat_commits(commit_ids, max_file_lines):
+    to_run = ['git', 'log', '--no-walk=unsorted', '--stdin',
+              '--pretty=medium', '-M', '--cc', '--numstat', '--stat']
+    start = time.time()
+    process = Popen(to_run, stdin=PIPE, stdout=PIPE)
+    timer = _watch(process)
+    output = process.communicate("".join([id + "\n" for id in commit_ids]))[0]
+    if timer is not None:
+        timer.cancel()
+    tracing.git_command(to_run, time.time() - start, len(output), process.returncode)
+
+    stats = []
+    for line in output.splitlines(True):
+        if len(stats) < len(commit_ids) and line.startswith("commit " + commit_ids[len(stats)]):
+            summary = []
+            oversized = set()
+            paths = set()
+            stats.append((commit_ids[len(stats)], summary, oversized, paths))
+            summary.append(line)
+            continue
+
+        m = _NUMSTAT_RE.match(line)
+        if m is None:
+            summary.append(line)
+            continue
+        # A rename touches both paths, but only the new one is left out
+        old_path, path = _numstat_paths(m.group(3).rstrip("\n"))
+        paths.update([old_path, path])
+        if max_file_lines is not None and m.group(1) != '-':
+            if int(m.group(1)) + int(m.group(2)) > max_file_lines:
+                oversized.add(path)
+
+    if process.returncode != 0 or len(stats) != len(commit_ids):
+        raise CalledProcessError(process.returncode, "git log --stdin --numstat")
+
+    return [(id, "".join(summary).strip(), oversized, paths)
+            for id, summary, oversized, paths in stats]
+
+# Show the stat and patch of all the given commits with one streaming
+# 'git log --stdin', rather than running two 'git show' for each. Yields
+# (commit_id, summary, patch, omitted_files) in the order given, where
+# summary is the 'git show --stat' output and patch is the 'git show -p'
+# output with deleted files left out (like --diff-filter=ACMRTUXB.)
+#
+# If max_size is given, the patch is cut down to whole file diffs so that
+# summary and patch together stay under that many bytes; omitted_files says
+# how many were dropped. The diffs that don't fit are never held in memory.
+#
+# Files matching one of the 'exclude' pathspecs, and files with more than
+# max_file_lines changed lines, only appear in the summary: a '--numstat'
+# pass finds them first, and the patches are then asked for with pathspecs
+# leaving them out, so git never generates their diffs.
+def show_commits(commit_ids, max_size=None, exclude=[], max_file_lines=None):
+    if not exclude and max_file_lines is None:
+        for shown in _show_commits(commit_ids, ['--stat', '-p'], max_size):
+            yield shown
+        return
+
+    stats = _stat_commits(commit_ids, max_file_lines)
+    exclude = [":(exclude)" + pathspec for pathspec in exclude]
+
+    # Consecutive commits share a 'git log' that leaves out all of their
+    # oversized files, as long as none of them shows a diff of one of those
+    # files in full. That is usually the whole push; only a file that is
+    # oversized in one commit and small in another of the same run makes
+    # for another 'git log'.
+    start = 0
+    while start < len(stats):
+        oversized = set(stats[start][2])
+        shown_paths = stats[start][3] - stats[start][2]
+        end = start + 1
+        while end < len(stats):
+            id, summary, commit_oversized, paths = stats[end]
+            if commit_oversized & shown_paths or (paths - commit_oversized) & oversized:
+                break
+            oversized |= commit_oversized
+            shown_paths |= paths - commit_oversized
+            end += 1
+
+        # Without --full-history --sparse, commits that only touch
+        # excluded files would be skipped
+        args = ['--full-history', '--sparse', '-p', '--'] + exclude + \
+               [":(exclude,literal)" + path for path in sorted(oversized)]
+        run = stats[start:end]
+        for shown in _show_commits([id for id, summary, oversized, paths in run], args, max_size,
+                                   [summary for id, summary, oversized, paths in run]):
+            yield shown
+        start = end
+
+# The streaming part of show_commits(): runs 'git log' with the given
+# arguments and splits its output. If 'summaries' is given, those are
+# used instead of the commit messages git prints.
+def _show_commits(commit_ids, args, max_size, summaries=None):
+    to_run = ['git', 'log', '--no-walk=unsorted', '--stdin',
+              '--pretty=medium', '-M', '--cc'] + args
+    start = time.time()
+    # Without a buffer, readline() would read a byte at a time
+    process = Popen(to_run, stdin=PIPE, stdout=PIPE, bufsize=-1)
+    timer = _watch(process)
+    # git reads all of stdin before it starts writing, so this can't deadlock
+    process.stdin.write("".join([id + "\n" for id in commit_ids]))
+    process.stdin.close()
+
+    def result(current_id, splitter):
+        summary, patch, omitted_files = splitter.finish()
+        if summaries is not None:
+            summary = summaries[index - 1]
+        return current_id, summary, patch, omitted_files
+
+    index = 0
+    current_id = None
+    splitter = None
+    finished = False
+    reader = _LogReader(process.stdout)
+    try:
+        line_start = True
+        for piece in iter(reader.readline, ""):
+            if line_start and index < len(commit_ids) and piece.startswith("commit " + commit_ids[index]):
+                if current_id is not None:
+                    yield result(current_id, splitter)
+                current_id = commit_ids[index]
+                index += 1
+                splitter = _LogOutputSplitter()
+                splitter.feed(piece)
+            elif splitter is not None:
+                if (max_size is not None and splitter.max_patch_size is None and
+                    line_start and _is_diff_header(piece)):
+                    # The summary is complete, the rest of the budget is for the patch
+                    if summaries is not None:
+                        summary_size = len(summaries[index - 1])
+                    else:
+                        summary_size = sum([len(s) for s in splitter.summary])
+                    splitter.max_patch_size = max(max_size - summary_size, 0)
+                splitter.feed(piece, line_start)
+            line_start = piece.endswith("\n")
+            if line_start and splitter is not None and splitter.skipping():
+                # Whatever comes before the next file or commit is dropped
+                reader.skip_to(_DIFF_HEADERS + ("commit ",))
+
+        # If git was killed, the last commit is incomplete
+        if current_id is not None and not process.timed_out:
+            yield result(current_id, splitter)
+        finished = True
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        if timer is not None:
+            timer.cancel()
+        # The duration includes the time our caller spent on each commit
+        tracing.git_command(to_run, time.time() - start, reader.bytes, returncode)
+
+    if finished and (returncode != 0 or process.timed_out or index != len(commit_ids)):
+        raise CalledProcessError(returncode, "git log --stdin")
+
+# What we need to know about the repository the hook runs in. GIT_DIR is
+# resolved once, and the whole hooks.* configuration section is read with a
+# single 'git config' when the first value is asked for.
+class Repository:
+    def __init__(self):
+        try:
+            self.git_dir = git.rev_parse(git_dir=True, _quiet=True)
+        except CalledProcessError:
+            die("GIT_DIR not set")
+        self.config = None
+
+    def _load_config(self):
+        self.config = {}
+        try:
+            output = git.config('^hooks\\.', z=True, get_regexp=True, _quiet=True)
+        except CalledProcessError:
+            # No hooks.* keys at all
+            return
+
+        for entry in output.split("\0"):
+            if entry == "":
+                continue
+            # A key without '= value' comes without the newline
+            key, _, value = entry.partition("\n")
+            self.config.setdefault(key, []).append(value)
+
+    def _get_values(self, key):
+        if self.config is None:
+            self._load_config()
+        # Section and key names are case insensitive and git gives them to
+        # us in lower case; a subsection in between is case sensitive
+        section, _, rest = key.partition(".")
+        subsection, _, name = rest.rpartition(".")
+        if subsection:
+            key = section.lower() + "." + subsection + "." + name.lower()
+        else:
+            key = section.lower() + "." + name.lower()
+        return self.config.get(key, [])
+
+    # Return the value of 'key', or None if it isn't set
+    def get_config(self, key):
+        values = self._get_values(key)
+        if not values:
+            return None
+        # Like 'git config <key>', the last value wins
+        return values[-1]
+
+    # Return all the values of a key that can be given several times
+    def get_config_all(self, key):
+        return list(self._get_values(key))
+
+_repository = None
+
+def get_repository():
+    global _repository
+    if _repository is None:
+        _repository = Repository()
+    return _repository
+
+# How many commits the daemon keeps in commit_cache between pushes
+MAX_COMMIT_CACHE_ENTRIES = 100000
+
+# For the daemon: start on a push to the repository at git_dir. Everything
+# known about the previous push is forgotten, except for commit_cache (a
+# commit is the same in every repository) and the cat-file processes.
+def switch_repository(git_dir):
+    global _repository, persistent_commit_cache
+
+    os.environ['GIT_DIR'] = git_dir
+    _repository = None
+    if persistent_commit_cache is not None:
+        persistent_commit_cache.db.close()
+        persistent_commit_cache = None
+    set_deadline(None)
+    mailmap_cache.clear()
+    if len(commit_cache) > MAX_COMMIT_CACHE_ENTRIES:
+        commit_cache.clear()
+    object_reader.use_repository(git_dir)
+
+# Count the commits reachable from 'include' but not from 'exclude'
+def count_commits(include, exclude=[]):
+    input = "".join([rev + "\n" for rev in include] +
+                    ["^" + rev + "\n" for rev in exclude])
+    return int(git.rev_list(count=True, stdin=True, _input=input, _quiet=True))
+
+# 'Name <email>' => the same as the repository's .mailmap maps it
+mailmap_cache = {}
+
+# Commits (and the caches) have the author as it is in the commit object,
+# since a commit can be in several repositories with different mailmaps;
+# this applies the mailmap, like %aN <%aE> would
+def map_author(author):
+    if author not in mailmap_cache:
+        try:
+            mailmap_cache[author] = git.check_mailmap(author).strip()
+        except CalledProcessError:
+            mailmap_cache[author] = author
+    return mailmap_cache[author]
+
+# Something that changes whenever the mailmap 'git log' applies here does,
+# for caches of text with author lines in it: whether log.mailmap is on,
+# and the contents of the work tree's .mailmap, of mailmap.file and of
+# mailmap.blob (HEAD:.mailmap by default in a bare repository)
+def get_mailmap_id():
+    import hashlib
+
+    config = {}
+    try:
+        output = git.config('^(log\\.mailmap|mailmap\\.(file|blob))$', z=True, get_regexp=True, _quiet=True)
+    except CalledProcessError:
+        output = ""
+    for entry in output.split("\0"):
+        key, _, value = entry.partition("\n")
+        config[key] = value
+
+    files = []
+    blob = config.get('mailmap.blob')
+    if git.rev_parse(is_bare_repository=True, _quiet=True).strip() == "true":
+        if blob is None:
+            blob = "HEAD:.mailmap"
+    else:
+        files.append(os.path.join(git.rev_parse(show_toplevel=True, _quiet=True).strip(), ".mailmap"))
+    if config.get('mailmap.file'):
+        files.append(os.path.expanduser(config['mailmap.file']))
+
+    parts = [config.get('log.mailmap', "")]
+    for path in files:
+        try:
+            f = open(path)
+        except IOError:
+            parts.append("")
+            continue
+        try:
+            parts.append(hashlib.sha1(f.read()).hexdigest())
+        finally:
+            f.close()
+    if blob:
+        try:
+            parts.append(git.rev_parse(blob, verify=True, _quiet=True).strip())
+        except CalledProcessError:
+            parts.append("")
+    return " ".join(parts)
+
+# Return the number of commits reachable from any ref; this is what
+# 'git rev-list --all | wc -l' prints. The count is remembered in GIT_DIR
+# along with the ref tips it was computed for, so that the next push only has
+# to walk the commits that were added or removed since then.
+def get_total_commit_count():
+    # Only needed when the cached count is out of date
+    import tempfile
+
+    git_dir = get_repository().git_dir
+
+    tips = set(git.for_each_ref(format="%(objectname)", _split_lines=True))
+    try:
+        tips.add(object_reader.info("HEAD")[0])
+    except CalledProcessError:
+        # Unborn HEAD
+        pass
+    tips = sorted(tips)
+
+    cache_file = os.path.join(git_dir, "email-hook-commit-count")
+    try:
+        f = open(cache_file)
+        try:
+            cached = f.read().split()
+        finally:
+            f.close()
+        cached_count = int(cached[0])
+        cached_tips = cached[1:]
+    except (IOError, ValueError, IndexError):
+        cached_tips = None
+
+    if cached_tips == tips:
+        return cached_count
+
+    count = None
+    if cached_tips is not None:
+        try:
+            count = (cached_count +
+                     count_commits(tips, cached_tips) -
+                     count_commits(cached_tips, tips))
+        except CalledProcessError:
+            # Old tips have been pruned; start from scratch
+            pass
+    if count is None:
+        count = count_commits(tips)
+
+    try:
+        fd, tmp_file = tempfile.mkstemp(prefix="email-hook-", dir=git_dir)
+        f = os.fdopen(fd, "w")
+        try:
+            f.write("%d\n" % count)
+            for tip in tips:
+                f.write(tip + "\n")
+        finally:
+            f.close()
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        # Not being able to cache the count isn't fatal
+        pass
+
+    return count
+
 # Return the directory name with .git stripped as a short identifier
 # for the module
 def get_module_name():
-    try:
-        git_dir = git.rev_parse(git_dir=True, _quiet=True)
-    except CalledProcessError:
-        die("GIT_DIR not set")
+    git_dir = get_repository().git_dir
 
     # Use the directory name with .git stripped as a short identifier
     absdir = os.path.abspath(git_dir)
@@ -194,10 +1103,7 @@ def get_module_name():
 
 # Return the project description or '' if it is 'Unnamed repository;'
 def get_project_description():
-    try:
-        git_dir = git.rev_parse(git_dir=True, _quiet=True)
-    except CalledProcessError:
-        die("GIT_DIR not set")
+    git_dir = get_repository().git_dir
 
     projectdesc = ''
     description = os.path.join(git_dir, 'description')
@@ -216,7 +1122,9 @@ def get_committer_email(rev, fallback_email):
 
     if rev:
         try:
-            git_email = git.show('--raw', '--pretty=format:%an <%aE>', rev)
+            git_email = load_commit(rev).author
+            if git_email is not None:
+                git_email = map_author(git_email)
         except CalledProcessError:
             die("GIT_ERROR retrieving email")
     else:
@@ -0,0 +1,205 @@
+# Building mails in files and sending them to the SMTP server from there
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# A commit mail can carry a diff of several megabytes twice, as plain text
+# and as HTML. Building it with the email package, flattening it with
+# as_string() and handing that to smtplib makes a copy of all of it at
+# every step: the encoded parts, the whole message, and the message with
+# its line ends and leading dots fixed up for SMTP. Here the message is
+# written part by part to a file, which is only kept in memory while it is
+# small, and sent to the server from there a chunk at a time. The message
+# is the same as the email package would have made.
+
+import base64
+import random
+import sys
+import tempfile
+from email.header import Header
+
+# Messages bigger than this are written to disk while they are built
+MAX_MEMORY_MESSAGE_SIZE = 1024 * 1024
+
+# How much of a body is encoded at a time; a multiple of the 57 bytes that
+# make up a line of base64
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+# How much of a message is sent to the server at a time
+SEND_CHUNK_SIZE = 64 * 1024
+
+def message_file():
+    return tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_MESSAGE_SIZE)
+
+def _make_boundary():
+    return "=" * 15 + "%019d" % random.randrange(sys.maxint) + "=="
+
+# Headers are folded the way email.generator does it
+def _write_headers(f, headers):
+    for name, value in headers:
+        try:
+            if isinstance(value, str):
+                value.decode('us-ascii')
+            value = Header(value, maxlinelen=78, header_name=name).encode()
+        except UnicodeError:
+            # 8 bit data in an unknown encoding can't be folded safely
+            pass
+        f.write("%s: %s\n" % (name, value))
+    f.write("\n")
+
+# Binary data doesn't end with a line break, and email.encoders doesn't
+# add one after its base64 either
+def _write_base64(f, data, final_newline=True):
+    for start in xrange(0, len(data), ENCODE_CHUNK_SIZE):
+        encoded = base64.encodestring(data[start:start + ENCODE_CHUNK_SIZE])
+        if not final_newline and start + ENCODE_CHUNK_SIZE >= len(data):
+            encoded = encoded[:-1]
+        f.write(encoded)
+
+def _write_text_part(f, subtype, text, headers=[]):
+    _write_headers(f, [('Content-Type', 'text/%s; charset="utf-8"' % subtype),
+                       ('MIME-Version', '1.0'),
+                       ('Content-Transfer-Encoding', 'base64')] + headers)
+    _write_base64(f, text)
+
+def _write_body(f, headers, body, html_body):
+    if html_body is None:
+        _write_text_part(f, 'plain', body, headers)
+        return
+
+    boundary = _make_boundary()
+    _write_headers(f, [('Content-Type', 'multipart/alternative; boundary="%s"' % boundary),
+                       ('MIME-Version', '1.0')] + headers)
+    for subtype, text in [('plain', body), ('html', html_body)]:
+        f.write("--%s\n" % boundary)
+        _write_text_part(f, subtype, text)
+        f.write("\n")
+    f.write("--%s--\n" % boundary)
+
+# Write a mail with the (name, value) pairs in 'headers', a UTF-8 plain
+# text body and, if 'html_body' isn't None, an alternative HTML body. An
+# 'attachment' is a (filename, content type, data) tuple.
+def write_message(f, headers, body, html_body=None, attachment=None):
+    if attachment is None:
+        _write_body(f, headers, body, html_body)
+        return
+
+    filename, content_type, data = attachment
+    boundary = _make_boundary()
+    _write_headers(f, [('Content-Type', 'multipart/mixed; boundary="%s"' % boundary),
+                       ('MIME-Version', '1.0')] + headers)
+    f.write("--%s\n" % boundary)
+    _write_body(f, [], body, html_body)
+    f.write("\n--%s\n" % boundary)
+    _write_headers(f, [('Content-Type', content_type),
+                       ('MIME-Version', '1.0'),
+                       ('Content-Transfer-Encoding', 'base64'),
+                       ('Content-Disposition', 'attachment; filename="%s"' % filename)])
+    _write_base64(f, data, data.endswith("\n"))
+    f.write("\n--%s--\n" % boundary)
+
+# Send the message read from 'f' (from where it is positioned) through the
+# smtplib.SMTP 'server'. Works like server.sendmail(), including what it
+# raises, but never has more than a chunk of the message in memory. All the
+# recipients are given in one transaction, unless the server only takes so
+# many per transaction (and says 452 to the rest); then the rest get the
+# message in another one. The recipients that got the message are added to
+# the list 'delivered', if one is given, as soon as they have it.
+def send_message(server, sender, recipients, f, delivered=None):
+    import smtplib
+
+    if isinstance(recipients, basestring):
+        recipients = [recipients]
+    start = f.tell()
+
+    server.ehlo_or_helo_if_needed()
+    options = []
+    if server.does_esmtp and server.has_extn('size'):
+        f.seek(0, 2)
+        options.append("size=%d" % (f.tell() - start))
+
+    refused = {}
+    sent = False
+    while True:
+        f.seek(start)
+        (code, response) = server.mail(sender, options)
+        if code != 250:
+            _abort(server, code)
+            raise smtplib.SMTPSenderRefused(code, response, sender)
+
+        accepted = []
+        deferred = []
+        for recipient in recipients:
+            (code, response) = server.rcpt(recipient)
+            if code in (250, 251):
+                accepted.append(recipient)
+            elif code == 452 and accepted:
+                deferred.append(recipient)
+            else:
+                refused[recipient] = (code, response)
+                if code == 421:
+                    _abort(server, code)
+                    raise smtplib.SMTPRecipientsRefused(refused)
+        if not accepted:
+            server.rset()
+            if sent:
+                return refused
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        _send_data(server, f)
+        sent = True
+        if delivered is not None:
+            delivered.extend(accepted)
+        if not deferred:
+            return refused
+        recipients = deferred
+
+# Give up on the transaction after the server answered 'code'. With 421
+# the server is closing the connection, so there is no point in a RSET
+# (smtplib would only raise SMTPServerDisconnected and hide the 421).
+def _abort(server, code):
+    if code == 421:
+        server.close()
+    else:
+        server.rset()
+
+def _send_data(server, f):
+    import smtplib
+
+    server.putcmd("data")
+    (code, response) = server.getreply()
+    if code != 354:
+        if code == 421:
+            server.close()
+        raise smtplib.SMTPDataError(code, response)
+
+    chunk = []
+    chunk_size = 0
+    for line in iter(f.readline, ''):
+        line = line.rstrip("\r\n")
+        if line.startswith("."):
+            line = "." + line
+        chunk.append(line + "\r\n")
+        chunk_size += len(line) + 2
+        if chunk_size >= SEND_CHUNK_SIZE:
+            server.send("".join(chunk))
+            chunk = []
+            chunk_size = 0
+    chunk.append(".\r\n")
+    server.send("".join(chunk))
+
+    (code, response) = server.getreply()
+    if code != 250:
+        _abort(server, code)
+        raise smtplib.SMTPDataError(code, response)
@@ -30,15 +30,16 @@
 # with as little clutter as possible.
 #
 
+# Only cheap modules are imported here; smtplib, email, multiprocessing,
+# the spool and Pygments are imported where they are used, so that a push that generates
+# no email doesn't pay for loading them.
 import re
 import os
 import sys
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from pygments import highlight
-from pygments.lexers import DiffLexer
-from pygments.formatters import HtmlFormatter
+import time
+import fnmatch
+from itertools import imap
+from subprocess import Popen
 
 script_path = os.path.realpath(os.path.abspath(sys.argv[0]))
 script_dir = os.path.dirname(script_path)
@@ -47,11 +48,17 @@ sys.path.insert(0, script_dir)
 
 from git import *
 from util import die, strip_string as s
+from diffhtml import format_diff_html
+import tracing
 
 # When we put a git subject into the Subject: line, where to truncate
 SUBJECT_MAX_SUBJECT_CHARS = 100
 MAX_HTML_BODY_SIZE = 5*1024*1024
 MAX_DETAIL_BODY_SIZE = 10*1024*1024
+# The size diffs are cut to when running out of time
+MAX_HURRIED_BODY_SIZE = 64*1024
+# The most of a diff that goes into a patch attachment, before compression
+MAX_ATTACHED_PATCH_SIZE = 100*1024*1024
 
 CREATE = 0
 UPDATE = 1
@@ -62,74 +69,553 @@ INVALID_TAG = 3
 projectshort = None
 debug = False
 
+# How to turn diffs into HTML: 'builtin' or 'pygments'
+html_renderer = 'builtin'
+
+# When a branch change brings in more new commits than this, send a single
+# digest instead of a mail for each one (hooks.max-commit-emails); None for
+# no limit
+max_commit_emails = None
+# List at most this many commits in a cover mail (hooks.max-summary-lines);
+# None for no limit
+max_summary_lines = None
+
+# Files whose diffs are left out of commit mails: pathspecs matching them
+# (hooks.diff-exclude), and a limit on changed lines (hooks.diff-max-file-lines)
+diff_exclude = []
+diff_max_file_lines = None
+
+# (ref glob, recipients) pairs (hooks.route): mails about a ref matching the
+# glob also go to the recipients
+recipient_routes = []
+
+# Commit mails bigger than this many bytes have their diff attached as a
+# compressed patch instead of inline (hooks.patch-attachment-size, in KB)
+patch_attachment_size = None
+
+# Number of commits in the repository, computed on first use
+total_commit_count = None
+
 # map of ref_name => Change object; this is used when computing whether
 # we've previously generated a detailed diff for a commit in the push
 all_changes = {}
 processed_changes = {}
 
+# PushGraph for the push; computed when the first branch change is prepared
+push_graph = None
+
+# RenderCache for commit mail bodies (hooks.render-cache), or None
+render_cache = None
+DEFAULT_RENDER_CACHE_SIZE_MB = 256
+
+# The time budget for the run in seconds (hooks.time-budget) and when it runs out
+time_budget = None
+run_deadline = None
+
+# As the deadline gets closer we do less and less: first we stop generating
+# HTML, then we cut diffs short, and once it has passed we only send
+# summaries of the commits
+FULL = 0
+NO_HTML = 1
+SHORT_DIFFS = 2
+SUMMARY_ONLY = 3
+
+def get_degradation():
+    if run_deadline is None:
+        return FULL
+    left = run_deadline - time.time()
+    if left <= 0:
+        return SUMMARY_ONLY
+    elif left < time_budget / 4.:
+        return SHORT_DIFFS
+    elif left < time_budget / 2.:
+        return NO_HTML
+    else:
+        return FULL
+
+# The Pygments highlight() function and the lexer and formatter to use with
+# it; imported and created on first use
+pygments_highlighter = None
+
+def get_pygments():
+    global pygments_highlighter
+    if pygments_highlighter is None:
+        from pygments import highlight
+        from pygments.lexers import DiffLexer
+        from pygments.formatters import HtmlFormatter
+
+        pygments_highlighter = (highlight,
+                                DiffLexer(encoding='latin1'),
+                                HtmlFormatter(encoding='latin1', full=True, noclasses=True, nobackground=True))
+    return pygments_highlighter
+
+# Return the body as highlighted HTML, or None if it is too big to bother
+# or can't be decoded
+def format_body_html(body):
+    if len(body) >= MAX_HTML_BODY_SIZE or get_degradation() >= NO_HTML:
+        return None
+
+    if html_renderer == 'pygments':
+        highlight, lexer, formatter = get_pygments()
+        try:
+            return highlight(body, lexer, formatter)
+        except UnicodeDecodeError:
+            return None
+    else:
+        return format_diff_html(body)
+
+def compress_patch(name, patch):
+    import gzip
+    from cStringIO import StringIO
+
+    out = StringIO()
+    f = gzip.GzipFile(name, 'wb', 6, out, 0)
+    f.write(patch)
+    f.close()
+    return out.getvalue()
+
+# Generate the plain text and HTML body of the email for a single commit
+# from an item of show_commits(), and the patch to attach to it: None, or
+# a (filename, content type, data) tuple. The last item of the result says
+# whether it was rendered in full, without cutting corners to save time.
+def render_commit(shown):
+    commit_id, body_summary, body_patch, omitted_files = shown
+    body = body_summary + "\n" + body_patch
+    if (patch_attachment_size is not None and len(body) > patch_attachment_size and
+        get_degradation() < SHORT_DIFFS):
+        # The diff is too big to read in a mail, but reviewers still want
+        # it; it usually compresses very well. The attachment is what the
+        # body would have been, which 'git apply' takes as it is.
+        name = commit_id + ".patch"
+        patch = (name + ".gz", 'application/gzip', compress_patch(name, body + "\n"))
+        body = body_summary + "\n\n (The diff is too big to include; it is attached as %s.gz) \n\n" % name
+        if omitted_files > 0:
+            body += " (The attached diff has been shortened. The diffs of %d file(s) are not included) \n\n" % omitted_files
+        return body, None, patch, get_degradation() == FULL
+
+    if omitted_files > 0:
+        body += "\n\n (The body has been shortened. The diffs of %d file(s) are not included) \n\n" % omitted_files
+    elif len(body) > MAX_HURRIED_BODY_SIZE and get_degradation() >= SHORT_DIFFS:
+        body = body[:body.rfind("\n", 0, MAX_HURRIED_BODY_SIZE)]
+        body += "\n\n (The body has been shortened to save time) \n\n"
+
+    html_body = format_body_html(body)
+    # The degradation only ever increases
+    return body, html_body, None, get_degradation() == FULL
+
+# Returns an iterator over (body, html_body, patch) for the given commits, in
+# order. Bodies are taken from the render cache if there is one; the others
+# are rendered, and added to it. (Mails with a patch attachment aren't cached;
+# the attachments would soon push everything else out.)
+def render_commits(commit_ids):
+    global render_cache
+
+    if render_cache is None:
+        cached = set()
+    else:
+        cached = set([id for id in commit_ids if render_cache.contains(id)])
+
+    rendered = _render_commits([id for id in commit_ids if id not in cached])
+    try:
+        for commit_id in commit_ids:
+            result = None
+            if commit_id in cached:
+                result = render_cache.get(commit_id)
+            if result is not None:
+                body, html_body = result
+                yield body, html_body, None
+                continue
+
+            if commit_id in cached:
+                # Evicted since we looked
+                body, html_body, patch, complete = _render_commits([commit_id]).next()
+            else:
+                body, html_body, patch, complete = rendered.next()
+
+            if complete and patch is None and render_cache is not None:
+                try:
+                    render_cache.put(commit_id, body, html_body)
+                except (IOError, OSError), e:
+                    print >>sys.stderr, "Render cache update failed, not using it: %s" % e
+                    render_cache = None
+
+            yield body, html_body, patch
+    finally:
+        rendered.close()
+
+# render_commits() without the cache; the results are those of render_commit().
+# The stats and diffs all come from a single git process. Formatting with
+# Pygments is CPU bound, so with it, or with enough commits, the formatting
+# is spread over a pool of worker processes. Only a few commits per worker
+# are rendered ahead of the one being sent, so that a slow relay doesn't
+# make the bodies of the whole push pile up in memory.
+def _render_commits(commit_ids):
+    if not commit_ids:
+        return
+
+    if get_degradation() >= SHORT_DIFFS:
+        max_size = MAX_HURRIED_BODY_SIZE
+    elif patch_attachment_size is not None:
+        max_size = MAX_ATTACHED_PATCH_SIZE
+    else:
+        max_size = MAX_DETAIL_BODY_SIZE
+    shown = show_commits(commit_ids, max_size=max_size,
+                         exclude=diff_exclude, max_file_lines=diff_max_file_lines)
+
+    # Passing the bodies back and forth costs about as much as the builtin
+    # formatter saves on a few commits
+    if html_renderer == 'pygments':
+        min_pool_commits = 2
+    else:
+        min_pool_commits = MIN_POOL_COMMITS
+    pool = None
+    if len(commit_ids) >= min_pool_commits:
+        pool = get_render_pool()
+
+    if pool is None:
+        for result in imap(render_commit, shown):
+            yield result
+        return
+
+    from collections import deque
+
+    window = RENDER_AHEAD * render_pool_jobs
+    pending = deque()
+    try:
+        for item in shown:
+            pending.append(pool.apply_async(render_commit, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # Anything still pending is left to finish; nobody collects it
+        shown.close()
+
+# The pool of worker processes that render commits, created on first use
+# and shared by the ref changes of a push; None if there is only one CPU
+render_pool = None
+render_pool_jobs = 0
+
+# How many commits a push needs before its bodies are rendered by the pool
+MIN_POOL_COMMITS = 16
+# How many commits per worker are rendered ahead of the one being sent
+RENDER_AHEAD = 2
+
+def get_render_pool():
+    global render_pool, render_pool_jobs
+
+    if render_pool is None and render_pool_jobs == 0:
+        import multiprocessing
+
+        try:
+            render_pool_jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            render_pool_jobs = 1
+        if render_pool_jobs > 1:
+            # The workers must not share our cat-file processes
+            render_pool = multiprocessing.Pool(render_pool_jobs, initializer=object_reader.detach)
+    return render_pool
+
+def close_render_pool():
+    global render_pool, render_pool_jobs
+
+    if render_pool is not None:
+        render_pool.terminate()
+        render_pool.join()
+    render_pool = None
+    render_pool_jobs = 0
+
+# The recipients that hooks.route adds for a ref, as address lists
+def get_routed_recipients(refname):
+    return [recipients for (pattern, recipients) in recipient_routes
+            if fnmatch.fnmatchcase(refname, pattern)]
+
+# The (name, address) pairs in a list of address lists
+# ('A <a@example.com>, b@example.com'), each address only once
+def get_address_pairs(address_lists):
+    from email.utils import getaddresses
+
+    pairs = []
+    seen = set()
+    for name, address in getaddresses(address_lists):
+        if address and address.lower() not in seen:
+            seen.add(address.lower())
+            pairs.append((name, address))
+    return pairs
+
+# The addresses in a list of address lists, each only once
+def get_addresses(address_lists):
+    return [address for name, address in get_address_pairs(address_lists)]
+
+# If the SMTP error 'e' means that the server wants us to slow down, how
+# long it asked us to wait (None if it didn't say), as a tuple; otherwise None
+def get_throttling(e):
+    import smtplib
+
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        errors = e.recipients.values()
+    elif isinstance(e, smtplib.SMTPResponseException):
+        errors = [(e.smtp_code, e.smtp_error)]
+    else:
+        return None
+
+    retry_after = None
+    for code, response in errors:
+        # 4.7.x are the enhanced status codes for policy reasons, like rates
+        if code not in (421, 451) and not (400 <= code < 500 and re.match(r"4\.7\.\d", response)):
+            return None
+        m = re.search(r"(\d+)\s*(s\b|sec|min)", response, re.IGNORECASE)
+        if m:
+            seconds = int(m.group(1))
+            if m.group(2).lower() == 'min':
+                seconds *= 60
+            if retry_after is None or seconds > retry_after:
+                retry_after = seconds
+    return (retry_after,)
+
+# How often a message is tried when the server keeps throttling us
+MAX_THROTTLED_ATTEMPTS = 10
+
+# Sends the emails for all the ref changes in a push. The SMTP session is
+# opened on the first message and kept open for the rest of the push, so we
+# only do the EHLO/STARTTLS/LOGIN dance once; close() must be called at the end.
 class Mailer(object):
+    # 'max_rate' is the most messages to send per second (hooks.smtp-max-rate)
     def __init__(self, smtp_host, smtp_port,
-                 smtp_fallback_mail, sender, sender_username, sender_password, use_tls, recipients, newrev):
+                 smtp_fallback_mail, sender, sender_username, sender_password, use_tls, recipients,
+                 max_rate=None):
+        from ratelimit import RateLimiter
+
         self.smtp_host = smtp_host
         self.smtp_port = smtp_port
         self.smtp_fallback_mail = smtp_fallback_mail
         self.sender = sender
         self.sender_password = sender_password
         self.recipients = recipients
-        self.newrev = newrev
         self.sender_username = sender_username
         self.use_tls = use_tls
+        self.server = None
+        # When the session was last used
+        self.last_used = None
+        self.rate_limiter = RateLimiter(max_rate)
 
-    def send(self, subject, message, html_message):
+    def connect(self):
+        import smtplib
+
+        timeout = get_timeout()
+        if timeout is None:
+            server = smtplib.SMTP(self.smtp_host, self.smtp_port)
+        else:
+            server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=timeout)
+        server.ehlo()
+        if self.use_tls is not None:
+            server.starttls()
+            server.ehlo()
+        if self.sender_username is not None and self.sender_username.strip() != '':
+            server.login(self.sender_username, self.sender_password)
+
+        self.server = server
+
+    # Send the message read from the file 'msg_file' to the list of addresses
+    # 'recipients'. When the server says we are sending too fast, we wait and
+    # try again (and send the following messages more slowly) rather than
+    # give up on the message. The same goes for recipients the server
+    # refuses for the time being while others get the message; those that
+    # already have it aren't sent it again. Recipients refused for good are
+    # reported and dropped.
+    def sendmail(self, sender, recipients, msg_file):
+        import smtplib
+        import socket
+        from mailstream import send_message
+
+        start = msg_file.tell()
+        delivered = []
+        attempts = 0
+        while True:
+            attempts += 1
+            self.rate_limiter.wait()
+            try:
+                if self.server is None:
+                    self.connect()
+
+                # What is left of the time budget when this message is sent
+                timeout = get_timeout()
+                if timeout is not None:
+                    self.server.sock.settimeout(timeout)
+
+                self.last_used = time.time()
+                msg_file.seek(start)
+                refused = send_message(self.server, sender,
+                                       [r for r in recipients if r not in delivered],
+                                       msg_file, delivered)
+                self.rate_limiter.sent()
+                if not refused:
+                    return
+                # The others got the message; the refused ones are handled
+                # like a message that nobody got
+                raise smtplib.SMTPRecipientsRefused(refused)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException,
+                    smtplib.SMTPRecipientsRefused), e:
+                throttling = get_throttling(e)
+                if isinstance(e, smtplib.SMTPServerDisconnected):
+                    if attempts == 1:
+                        # The server may have timed out an idle session;
+                        # retry at once on a fresh connection
+                        self.drop_server()
+                        continue
+                    # A server closing the connection on us again is
+                    # throttling us too
+                    throttling = (None,)
+                elif isinstance(e, smtplib.SMTPRecipientsRefused):
+                    temporary = dict([(recipient, error) for recipient, error in e.recipients.items()
+                                      if 400 <= error[0] < 500])
+                    if not temporary and not delivered:
+                        raise
+                    for recipient, (code, response) in sorted(e.recipients.items()):
+                        if recipient not in temporary:
+                            print >>sys.stderr, "Mail to %s refused: %d %s" % (recipient, code, response)
+                            recipients = [r for r in recipients if r != recipient]
+                    if not temporary:
+                        return
+                    # Whatever the reason, those may get through later
+                    throttling = get_throttling(smtplib.SMTPRecipientsRefused(temporary)) or (None,)
+                if throttling is None or attempts >= MAX_THROTTLED_ATTEMPTS:
+                    raise
+
+                delay = self.rate_limiter.throttled(*throttling)
+                if run_deadline is not None and time.time() + delay > run_deadline:
+                    raise
+
+                if self.server is not None and self.server.sock is None:
+                    # The server closed the connection (421)
+                    self.drop_server()
+                elif self.server is not None:
+                    # Start over cleanly in the same session
+                    try:
+                        self.server.rset()
+                    except (smtplib.SMTPException, socket.error):
+                        self.drop_server()
+                time.sleep(delay)
+
+    # Forget the SMTP session without the QUIT, which the server won't answer
+    def drop_server(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    # 'rev' is the revision whose author the email is sent from; 'attachment'
+    # is a (filename, content type, data) tuple. The email goes to the mailing
+    # list and the address lists in 'extra_recipients'; it is built once and
+    # sent to all of them together.
+    def send(self, subject, message, html_message, rev, attachment=None, extra_recipients=[]):
 
         global debug
         if (debug):
             print message
             return
 
-        if not self.recipients:
+        # The same addresses go into the To header and the envelope
+        to = get_address_pairs([recipients for recipients in [self.recipients] + extra_recipients
+                                if recipients])
+        if not to:
             return
 
-        committer = get_committer_email(self.newrev, self.smtp_fallback_mail)
+        from email.utils import formataddr
+        from mailstream import message_file, write_message
+
+        committer = get_committer_email(rev, self.smtp_fallback_mail)
 
         if committer is None:
             committer = "{0}@{1}".format('unknown', self.smtp_fallback_mail)
 
-        if html_message:
-            msg = MIMEMultipart('alternative')
-            msg['From'] = committer
-            msg['To'] = self.recipients
-            msg['Subject'] = subject
+        # The message is built in a file rather than as a string, so that a
+        # big diff isn't copied around in memory over and over
+        msg_file = message_file()
+        try:
+            write_message(msg_file,
+                          [('From', committer), ('To', ", ".join([formataddr(pair) for pair in to])),
+                           ('Subject', subject)],
+                          message, html_message or None, attachment)
+            msg_file.seek(0)
+            self.sendmail(self.sender, [address for name, address in to], msg_file)
+        finally:
+            msg_file.close()
+
+    def close(self):
+        if self.server is None:
+            return
+
+        import smtplib
 
-            part1 = MIMEText(message, 'plain', 'utf-8')
-            part2 = MIMEText(html_message, 'html', 'utf-8')
+        try:
+            self.server.quit()
+        except smtplib.SMTPServerDisconnected:
+            pass
+        self.server = None
+        self.last_used = None
+
+# Whether a failed delivery is worth retrying later
+def is_permanent_failure(e):
+    import smtplib
+
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        codes = [code for (code, resp) in e.recipients.values()]
+        return min(codes) >= 500
+    elif isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code >= 500
+    else:
+        return False
 
-            msg.attach(part1)
-            msg.attach(part2)
-        else:
-            msg = MIMEText(message, _charset='utf-8')
-            msg['From'] = committer
-            msg['To'] = self.recipients
-            msg['Subject'] = subject
+# Instead of talking to the SMTP server, write the messages into an on-disk
+# spool and leave the delivery to a 'post-receive-email.py --drain' process
+# started in the background, so that git push doesn't wait for the relay.
+class SpoolMailer(Mailer):
+    def __init__(self, spool_dir, *args):
+        from spool import Spool
+
+        Mailer.__init__(self, *args)
+        self.spool = Spool(spool_dir)
+        self.spooled = 0
+
+    def sendmail(self, sender, recipients, msg_file):
+        if self.spooled == 0:
+            self.spool.create()
+        self.spool.add(sender, ", ".join(recipients), msg_file)
+        self.spooled += 1
+
+    def close(self):
+        if self.spooled == 0:
+            return
 
-        server = smtplib.SMTP(self.smtp_host, self.smtp_port)
-        server.ehlo()
-        if self.use_tls is not None:
-            server.starttls()
-            server.ehlo()
-        if self.sender_username is not None and self.sender_username.strip() != '':
-            server.login(self.sender_username, self.sender_password)
+        # Detach the drainer from the hook's stdout/stderr, otherwise git
+        # would wait for it before finishing the push
+        log = open(os.path.join(self.spool.path, 'drain.log'), 'a')
+        Popen([sys.executable, script_path, '--drain'],
+              stdin=open(os.devnull), stdout=log, stderr=log,
+              close_fds=True, preexec_fn=os.setsid)
+        log.close()
+        self.spooled = 0
+
+def drain_spool(spool_dir, mailer):
+    from spool import Spool
+
+    def log(message):
+        print >>sys.stderr, time.strftime("%Y-%m-%d %H:%M:%S"), message
 
-        server.sendmail(self.sender, self.recipients,
-                        msg.as_string())
-        server.rset()
-        server.quit()
+    def deliver(sender, recipients, msg_file):
+        mailer.sendmail(sender, get_addresses([recipients]), msg_file)
+
+    spool = Spool(spool_dir)
+    spool.create()
+    try:
+        spool.drain(deliver, is_permanent_failure, log)
+    finally:
+        mailer.close()
 
 class RefChange(object):
-    def __init__(self, recipients, smtp_host, smtp_port,
-                 smtp_fallback_mail, sender, sender_username, sender_password, use_tls,
-                 refname, oldrev, newrev):
-        self.mailer = Mailer(smtp_host, smtp_port, smtp_fallback_mail, sender, sender_username, sender_password, use_tls, recipients, newrev)
+    def __init__(self, mailer, refname, oldrev, newrev):
+        self.mailer = mailer
         self.refname = refname
         self.oldrev = oldrev
         self.newrev = newrev
@@ -149,6 +635,19 @@ class RefChange(object):
         else:
             self.short_refname = refname
 
+        self.extra_recipients = get_routed_recipients(refname)
+
+        # Seconds spent in each phase, for tracing
+        self.timings = { 'prepare': 0., 'render': 0., 'send': 0. }
+
+    # Call f(*args, **kwargs), adding the time it takes to the given phase
+    def timed(self, phase, f, *args, **kwargs):
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.timings[phase] += time.time() - start
+
     # Do any setup before sending email. The __init__ function should generally
     # just record the parameters passed in and not do git work. (The main reason
     # for the split is to let the prepare stage do different things based on
@@ -190,16 +689,13 @@ class RefChange(object):
 
         html_body = None
 
-        body = self.get_body()
+        body = self.timed('render', self.get_body)
 
-        if len(body) < MAX_HTML_BODY_SIZE:
-            try:
-                if self.get_format_body_html():
-                    html_body = highlight(body, DiffLexer(encoding='latin1'), HtmlFormatter(full=True, noclasses=True, nobackground=True, encoding='latin1'))
-            except UnicodeDecodeError:
-                html_body = None
+        if self.get_format_body_html():
+            html_body = self.timed('render', format_body_html, body)
 
-        self.mailer.send(subject, body, html_body)
+        self.timed('send', self.mailer.send, subject, body, html_body, self.newrev,
+                   extra_recipients=self.extra_recipients)
 
     # Allow multiple emails to be sent - used for branch updates
     def send_extra_emails(self):
@@ -211,6 +707,87 @@ class RefChange(object):
 
 # ========================
 
+# The part of the history that any branch change in the push might need to
+# send mails for, loaded with a single walk. Each BranchChange then finds
+# its own new commits in here, which is what
+#
+#   git rev-list <newrev> ^<other branch> ^<other branch>...
+#
+# would return (see BranchChange.prepare() for what is excluded), without
+# walking history again or passing every branch on the command line.
+#
+# The walk starts from the old and new tips of the branches updated in this
+# push, and leaves out what is reachable from other branches. It also leaves
+# out what is reachable from both the old and the new tip of an updated
+# branch; every change excludes one or the other, whether that branch has
+# been processed yet or not.
+class PushGraph(object):
+    def __init__(self):
+        self.branch_tips = {}
+        for line in git.for_each_ref('refs/heads/', format='%(refname) %(objectname)', _split_lines=True):
+            refname, id = line.split(" ")
+            self.branch_tips[refname] = id
+
+        include = []
+        exclude = []
+        for refname, id in self.branch_tips.iteritems():
+            if refname in all_changes:
+                change = all_changes[refname]
+                include.append(id)
+                if change.change_type != CREATE:
+                    include.append(change.oldrev)
+                    try:
+                        exclude.extend(git.merge_base(change.oldrev, id, all=True, _quiet=True, _split_lines=True))
+                    except CalledProcessError:
+                        # Unrelated histories
+                        pass
+            else:
+                exclude.append(id)
+
+        input = "".join([id + "\n" for id in include] + ["^" + id + "\n" for id in exclude])
+        # Kept in rev-list order, which the callers rely on
+        self.order = []
+        self.parents = {}
+        for line in git.rev_list(parents=True, stdin=True, _input=input, _split_lines=True):
+            ids = line.split()
+            self.order.append(ids[0])
+            self.parents[ids[0]] = ids[1:]
+
+    # All commits in the graph reachable from the given commits
+    def reachable(self, ids):
+        result = set()
+        stack = [id for id in ids if id in self.parents]
+        while stack:
+            id = stack.pop()
+            if id in result:
+                continue
+            result.add(id)
+            for parent in self.parents[id]:
+                if parent in self.parents and not parent in result:
+                    stack.append(parent)
+        return result
+
+    # The commits we need to send mails about for a branch change, in
+    # rev-list order; this depends on which changes were already processed
+    def get_new_commits(self, change):
+        exclude = []
+        for branch, id in self.branch_tips.iteritems():
+            if branch == change.refname:
+                # For this branch, exclude commits before 'oldrev'
+                if change.change_type != CREATE:
+                    exclude.append(change.oldrev)
+            elif branch in all_changes and not branch in processed_changes:
+                # For branches that were updated in this push but we haven't processed
+                # yet, exclude commits before their old revisions
+                if all_changes[branch].change_type != CREATE:
+                    exclude.append(all_changes[branch].oldrev)
+            else:
+                # Exclude commits that are ancestors of all other branches
+                exclude.append(id)
+
+        new_commits = self.reachable([change.newrev]) - self.reachable(exclude)
+        return [id for id in self.order if id in new_commits]
+
 # Common baseclass for BranchCreation and BranchUpdate (but not BranchDeletion)
 class BranchChange(RefChange):
     def __init__(self, *args):
@@ -228,25 +805,11 @@ class BranchChange(RefChange):
         # But new commits will always show up in a cover mail in any case; even
         # someone who maliciously is trying to fool us can't hide all trace.
 
-        # Ordering matters here, so we can't rely on kwargs
-        branches = git.rev_parse('--symbolic-full-name', '--branches', _split_lines=True)
-        detailed_commit_args = [ self.newrev ]
+        global push_graph
+        if push_graph is None:
+            push_graph = PushGraph()
 
-        for branch in branches:
-            if branch == self.refname:
-                # For this branch, exclude commits before 'oldrev'
-                if self.change_type != CREATE:
-                    detailed_commit_args.append("^" + self.oldrev)
-            elif branch in all_changes and not branch in processed_changes:
-                # For branches that were updated in this push but we haven't processed
-                # yet, exclude commits before their old revisions
-                if all_changes[branch].change_type != CREATE:
-                    detailed_commit_args.append("^" + all_changes[branch].oldrev)
-            else:
-                # Exclude commits that are ancestors of all other branches
-                detailed_commit_args.append("^" + branch)
-
-        detailed_commits = git.rev_list(*detailed_commit_args).splitlines()
+        detailed_commits = push_graph.get_new_commits(self)
 
         self.detailed_commits = set()
         for id in detailed_commits:
@@ -275,16 +838,17 @@ class BranchChange(RefChange):
                 except CalledProcessError:
                     self.added_commits = []
                 else:
-                    self.added_commits = rev_list_commits(parent + ".." + self.newrev)
+                    self.added_commits = rev_list_commits(parent + ".." + self.newrev, parents=True)
                     self.added_commits.reverse()
             else:
                 self.added_commits = []
             self.removed_commits = []
         else:
-            self.added_commits = rev_list_commits(self.oldrev + ".." + self.newrev)
-            self.added_commits.reverse()
-            self.removed_commits = rev_list_commits(self.newrev + ".." + self.oldrev)
-            self.removed_commits.reverse()
+            # One walk over the symmetric difference gives us both sides
+            commits = rev_list_commits(self.oldrev + "..." + self.newrev, parents=True, left_right=True)
+            commits.reverse()
+            self.added_commits = [commit for commit in commits if commit.side == '>']
+            self.removed_commits = [commit for commit in commits if commit.side == '<']
 
         # In some cases we'll send a cover email that describes the overall
         # change to the branch before ending individual mails for commits. In other
@@ -294,6 +858,7 @@ class BranchChange(RefChange):
         # - If it's not a fast forward
         # - If there are any merge commits
         # - If there are any commits we won't send separately (already in repo)
+        # - If there are too many new commits to send separately (an import)
 
         have_merge_commits = False
         for commit in self.added_commits:
@@ -305,6 +870,20 @@ class BranchChange(RefChange):
                                   have_merge_commits or
                                   len(self.detailed_commits) < len(self.added_commits))
 
+        # Pushing an imported history shouldn't produce thousands of mails,
+        # and once we are out of time there is no time for any. self.digest
+        # says why only the cover mail is sent.
+        if max_commit_emails is not None and len(self.detailed_commits) > max_commit_emails:
+            self.digest = ("There are %d new commits, more than the limit of %d; no separate mails sent" %
+                           (len(self.detailed_commits), max_commit_emails))
+        elif self.detailed_commits and get_degradation() == SUMMARY_ONLY:
+            self.digest = ("Out of time; no separate mails sent for the %d new commits" %
+                           len(self.detailed_commits))
+        else:
+            self.digest = None
+        if self.digest:
+            self.needs_cover_email = True
+
     def get_needs_main_email(self):
         return self.needs_cover_email
 
@@ -320,33 +899,58 @@ class BranchChange(RefChange):
     # a detailed email. (Set the False when listing removed commits)
     def generate_commit_summary(self, commits, show_details=True):
         detail_note = False
-        summary = ""
-        for commit in commits:
-            if show_details and not commit.id in self.detailed_commits:
+        lines = []
+        for commit in commits[:max_summary_lines]:
+            if show_details and not self.digest and not commit.id in self.detailed_commits:
                 detail = " (*)"
                 detail_note = True
             else:
                 detail = ""
-            summary += "  " + commit_oneline(commit) + detail + "\n"
+            lines.append("  " + commit_oneline(commit) + detail + "\n")
+
+        if max_summary_lines is not None and len(commits) > max_summary_lines:
+            lines.append("  ... and %d more\n" % (len(commits) - max_summary_lines))
 
         if detail_note:
-            summary += "\n(*) This commit already existed in another branch; no separate mail sent"
+            lines.append("\n(*) This commit already existed in another branch; no separate mail sent")
+        elif show_details and self.digest:
+            lines.append("\n" + self.digest)
 
-        return summary
+        return "".join(lines)
 
     def send_extra_emails(self):
+        global total_commit_count
+
+        # The cover mail is the digest; don't even look at the diffs
+        if self.digest:
+            return
+
         total = len(self.added_commits)
 
-        for i, commit in enumerate(self.added_commits):
-            if not commit.id in self.detailed_commits:
-                continue
+        detailed = [(i, commit) for (i, commit) in enumerate(self.added_commits)
+                    if commit.id in self.detailed_commits]
+        bodies = render_commits([commit.id for (i, commit) in detailed])
 
-            if self.short_refname == 'master':
-                branch = ""
-            else:
-                branch = "/" + self.short_refname
+        if self.short_refname == 'master':
+            branch = ""
+        else:
+            branch = "/" + self.short_refname
+
+        for n, (i, commit) in enumerate(detailed):
+            body = None
+            if get_degradation() < SUMMARY_ONLY:
+                try:
+                    body, html_body, patch = self.timed('render', bodies.next)
+                except CalledProcessError:
+                    # Unless git was killed for running past the deadline
+                    if get_degradation() < SUMMARY_ONLY:
+                        raise
+
+            if body is None:
+                bodies.close()
+                self.send_summary_email(branch, [commit for (i, commit) in detailed[n:]])
+                break
 
-            total = len(self.added_commits)
             if total > 1 and self.needs_cover_email:
                 count_string = ": %(index)s/%(total)s" % {
                     'index' : i + 1,
@@ -355,11 +959,15 @@ class BranchChange(RefChange):
             else:
                 count_string = ""
 
+            # The ref tips don't move while we run, so one count serves the whole push
+            if total_commit_count is None:
+                total_commit_count = get_total_commit_count()
+
             subject = "[%(projectshort)s%(branch)s%(count_string)s] [%(revision)s] %(subject)s" % {
                 'projectshort' : projectshort,
                 'branch' : branch,
                 'count_string' : count_string,
-                'revision' : git.rev_list('--all').count('\n') + 1 - (total - (i + 1)),
+                'revision' : total_commit_count - (total - (i + 1)),
                 'subject' : commit.subject[0:SUBJECT_MAX_SUBJECT_CHARS]
                 }
 
@@ -373,21 +981,29 @@ class BranchChange(RefChange):
             #    self.generate_header(subject,
             #                         include_revs=True,
             #                         oldrev=parent, newrev=commit.id)
-            body_summary = git.show(commit.id, M=True, stat=True)
 
-            body =  body_summary + "\n" + \
-                    git.show(commit.id, p=True, M=True, diff_filter="ACMRTUXB", pretty="format:---")
-            if len(body) > MAX_DETAIL_BODY_SIZE:
-                body = body_summary + "\n (The body has been shortened. Not all diffs are included) \n\n"
+            self.timed('send', self.mailer.send, subject, body, html_body, commit.id, patch,
+                       extra_recipients=self.extra_recipients)
 
-            html_body = None
-            if len(body) < MAX_HTML_BODY_SIZE:
-                try:
-                    html_body = highlight(body, DiffLexer(encoding='latin1'), HtmlFormatter(encoding='latin1', full=True, noclasses=True, nobackground=True))
-                except UnicodeDecodeError:
-                    html_body = None
+    # Once out of time, list the commits we haven't sent mails for in one mail
+    def send_summary_email(self, branch, commits):
+        subject = "[%(projectshort)s%(branch)s] (%(count)d more commits) ...%(subject)s" % {
+            'projectshort' : projectshort,
+            'branch' : branch,
+            'count' : len(commits),
+            'subject' : commits[-1].subject[0:SUBJECT_MAX_SUBJECT_CHARS]
+            }
+
+        body = s("""
+Out of time; no separate mails sent for these commits:
+
+%(summary)s
+""") % {
+            'summary': self.generate_commit_summary(commits, show_details=False)
+        }
 
-            self.mailer.send(subject, body, html_body)
+        self.timed('send', self.mailer.send, subject, body, None, commits[-1].id,
+                   extra_recipients=self.extra_recipients)
 
 class BranchCreation(BranchChange):
     def __init__(self, *args):
@@ -507,7 +1123,7 @@ class AnnotatedTagChange(RefChange):
     def prepare(self):
         # Resolve tag to commit
         if self.oldrev:
-            self.old_commit_id = git.rev_parse(self.oldrev + "^{commit}")
+            self.old_commit_id = object_reader.info(self.oldrev + "^{commit}")[0]
 
         if self.newrev:
             self.parse_tag_object(self.newrev)
@@ -525,7 +1141,8 @@ class AnnotatedTagChange(RefChange):
         self.date = "at an unknown time"
 
         self.have_signature = False
-        for line in git.cat_file(revision, p=True, _split_lines=True):
+        id, type, contents = object_reader.read(revision)
+        for line in contents.strip().splitlines():
             if in_message:
                 # Nobody is going to verify the signature by extracting it
                 # from the email, so strip it, and remember that we saw it
@@ -577,6 +1194,11 @@ Changes:
 """)
             revision_range = self.newrev
 
+        # A tag on top of a long untagged history would list all of it
+        short_log = git.shortlog(revision_range).split("\n")
+        if max_summary_lines is not None and len(short_log) > max_summary_lines:
+            short_log = short_log[:max_summary_lines] + ["      ... and %d more lines" % (len(short_log) - max_summary_lines)]
+
         extra += s("""
 
 %(short_log)s
@@ -584,7 +1206,7 @@ Changes:
 %(short_stat)s
 
 """) % {
-           'short_log': git.shortlog(revision_range),
+           'short_log': "\n".join(short_log),
            'short_stat': git.diff(revision_range, shortstat=True)
        }
 
@@ -739,8 +1361,8 @@ The ref '%(refname)s' was deleted. It previously pointed nowhere.
 # ========================
 
 class MiscChange(RefChange):
-    def __init__(self, recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_username, smtp_sender_pass, use_tls, refname, oldrev, newrev, message):
-        RefChange.__init__(self, recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_username, smtp_sender_pass, use_tls, refname, oldrev, newrev)
+    def __init__(self, mailer, refname, oldrev, newrev, message):
+        RefChange.__init__(self, mailer, refname, oldrev, newrev)
         self.message = message
 
 class MiscCreation(MiscChange):
@@ -844,6 +1466,7 @@ The ref for a pull request '%(refname)s' was created pointing to:
 class EmptyUpdate:
     def __init__ (self, refname):
         self.refname = refname
+        self.timings = {}
 
     def prepare (self):
         # do nothing
@@ -853,25 +1476,35 @@ class EmptyUpdate:
         # do not send emails either
         pass
 
-def make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_username, smtp_sender_pass, use_tls, oldrev, newrev, refname):
-    refname = refname
+# Whether an update to the ref can result in an email at all. This only
+# looks at the name, so that uninteresting refs (remotes, CI namespaces...)
+# can be skipped without running git.
+def ref_has_email(refname):
+    return (re.match(r'^refs/(heads|tags)/', refname) is not None or
+            re.match(r'^refs/pull/.*/(head|merge)$', refname) is not None)
+
+# Return the full ID for a revision; what the hook gets on stdin already is
+def canonicalize_rev(rev):
+    if re.match(r'^[0-9a-f]{40}$', rev):
+        return rev
+    return git.rev_parse(rev)
+
+def make_change(mailer, oldrev, newrev, refname):
+    if not ref_has_email(refname):
+        return EmptyUpdate(refname)
 
     # Canonicalize
-    oldrev = git.rev_parse(oldrev)
-    newrev = git.rev_parse(newrev)
+    oldrev = canonicalize_rev(oldrev)
+    newrev = canonicalize_rev(newrev)
 
     # Replacing the null revision with None makes it easier for us to test
     # in subsequent code
 
     if re.match(r'^0+$', oldrev):
         oldrev = None
-    else:
-        oldrev = oldrev
 
     if re.match(r'^0+$', newrev):
         newrev = None
-    else:
-        newrev = newrev
 
     # Figure out what we are doing to the ref
 
@@ -885,15 +1518,15 @@ def make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sende
         change_type = UPDATE
         target = newrev
     else:
-        return InvalidRefDeletion(refname, oldrev, newrev)
+        return InvalidRefDeletion(mailer, refname, oldrev, newrev)
 
-    object_type = git.cat_file(target, t=True)
+    object_type = object_reader.info(target)[1]
 
     # And then create the right type of change object
 
     # Closing the arguments like this simplifies the following code
     def make(cls, *args):
-        return cls(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_username, smtp_sender_pass, use_tls, refname, oldrev, newrev, *args)
+        return cls(mailer, refname, oldrev, newrev, *args)
 
     def make_misc_change(message):
         if change_type == CREATE:
@@ -930,8 +1563,6 @@ def make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sende
                 return make(BranchUpdate)
         else:
             return make_misc_change("%s is not a commit object" % target)
-    elif re.match(r'^refs/remotes/.*$', refname):
-        return EmptyUpdate(refname)
     elif re.match(r'^refs/pull/.*/head$', refname):
         return make(MiscCreatePullRequest)
     elif re.match(r'^refs/pull/.*/merge$', refname):
@@ -939,35 +1570,32 @@ def make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sende
     else:
         return EmptyUpdate(refname)
 
-def main():
+# Send the mails for the given (oldrev, newrev, refname) updates of the
+# repository, or with drain=True, deliver what is in the spool. The daemon
+# passes the SMTP sessions it keeps open in 'mailers'.
+def handle_push(repository, updates, drain=False, mailers=None):
     global projectshort
 
-    # No emails for a repository in the process of being imported
-    git_dir = git.rev_parse(git_dir=True, _quiet=True)
-    if os.path.exists(os.path.join(git_dir, 'pending')):
-        return
+    start_time = time.time()
+
+    # Everything we know about a previous push (in the daemon) is stale
+    global total_commit_count, push_graph
+    total_commit_count = None
+    push_graph = None
+    all_changes.clear()
+    processed_changes.clear()
 
+    git_dir = repository.git_dir
     projectshort = get_module_name()
 
     def get_config(hook, skip=False):
-        hook_val = None
-        try:
-            hook_val = git.config(hook, _quiet=True)
-        except CalledProcessError:
-            pass
+        hook_val = repository.get_config(hook)
 
         if not hook_val and not skip:
             die("%s is not set" % hook)
 
         return hook_val
 
-    global debug
-    if (len(sys.argv) > 1):
-        debug = True
-        print "Debug Mode on"
-    else:
-        debug = False
-
     recipients = get_config("hooks.mailinglist", debug)
     use_tls = get_config("hooks.use-tls", True)
     smtp_host = get_config("hooks.smtp-host", debug)
@@ -976,30 +1604,332 @@ def main():
     smtp_sender = get_config("hooks.smtp-sender", debug)
     smtp_sender_user = get_config("hooks.smtp-sender-username", True)
     smtp_sender_pass = get_config("hooks.smtp-sender-password", True)
+    spool_dir = get_config("hooks.spool-dir", True)
+    if spool_dir:
+        spool_dir = os.path.join(git_dir, spool_dir)
+    commit_cache_path = get_config("hooks.commit-cache", True)
+    commit_cache_size = get_config("hooks.commit-cache-size", True)
+
+    global html_renderer
+    html_renderer = get_config("hooks.html-renderer", True) or 'builtin'
+    if html_renderer not in ('builtin', 'pygments'):
+        die("hooks.html-renderer must be 'builtin' or 'pygments'")
+
+    global max_commit_emails, max_summary_lines
+    if get_config("hooks.max-commit-emails", True):
+        max_commit_emails = int(get_config("hooks.max-commit-emails", True))
+    else:
+        max_commit_emails = None
+    if get_config("hooks.max-summary-lines", True):
+        max_summary_lines = int(get_config("hooks.max-summary-lines", True))
+    else:
+        max_summary_lines = None
 
-    changes = []
+    # (The drainer runs in the background and has all the time it needs)
+    global time_budget, run_deadline
+    if get_config("hooks.time-budget", True) and not drain:
+        time_budget = float(get_config("hooks.time-budget", True))
+        run_deadline = start_time + time_budget
+    else:
+        time_budget = None
+        run_deadline = None
+    set_deadline(run_deadline)
+
+    global diff_exclude, diff_max_file_lines
+    diff_exclude = (get_config("hooks.diff-exclude", True) or "").split()
+    if get_config("hooks.diff-max-file-lines", True):
+        diff_max_file_lines = int(get_config("hooks.diff-max-file-lines", True))
+    else:
+        diff_max_file_lines = None
+
+    global recipient_routes
+    recipient_routes = []
+    for route in repository.get_config_all("hooks.route"):
+        fields = route.split(None, 1)
+        if len(fields) != 2:
+            die("hooks.route must be '<ref glob> <recipients>', not '%s'" % route)
+        recipient_routes.append((fields[0], fields[1].strip()))
+
+    global patch_attachment_size
+    if get_config("hooks.patch-attachment-size", True):
+        # Bodies are never bigger than MAX_DETAIL_BODY_SIZE
+        patch_attachment_size = min(int(get_config("hooks.patch-attachment-size", True)) * 1024,
+                                    MAX_DETAIL_BODY_SIZE)
+    else:
+        patch_attachment_size = None
+
+    # The environment variable is for tracing a single run by hand
+    trace_path = os.environ.get("EMAIL_HOOK_TRACE")
+    if not trace_path:
+        trace_path = get_config("hooks.trace", True)
+        if trace_path:
+            trace_path = os.path.join(git_dir, trace_path)
+    if trace_path:
+        tracing.enable(trace_path)
+    else:
+        tracing.disable()
+
+    smtp_max_rate = get_config("hooks.smtp-max-rate", True)
+    if smtp_max_rate:
+        smtp_max_rate = float(smtp_max_rate)
+        if smtp_max_rate <= 0:
+            die("hooks.smtp-max-rate must be more than 0")
+    else:
+        smtp_max_rate = None
+
+    mailer_args = (smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_user, smtp_sender_pass, use_tls, recipients,
+                   smtp_max_rate)
+
+    if drain:
+        if not spool_dir:
+            die("hooks.spool-dir is not set")
+        drain_spool(spool_dir, Mailer(*mailer_args))
+        return
 
-    if len(sys.argv) > 1:
+    if commit_cache_path:
+        if commit_cache_size:
+            commit_cache_size = int(commit_cache_size)
+        open_persistent_commit_cache(os.path.join(git_dir, commit_cache_path), commit_cache_size)
+
+    global render_cache
+    render_cache_path = get_config("hooks.render-cache", True)
+    if render_cache_path:
+        from rendercache import RenderCache
+
+        render_cache_size = int(get_config("hooks.render-cache-size", True) or DEFAULT_RENDER_CACHE_SIZE_MB)
+        # Everything besides the commit that makes a difference to the body
+        settings = [html_renderer, " ".join(diff_exclude), str(diff_max_file_lines),
+                    str(MAX_DETAIL_BODY_SIZE), str(MAX_HTML_BODY_SIZE)]
+        if patch_attachment_size is not None:
+            settings.append("patch-attachment-size=%d" % patch_attachment_size)
+        if html_renderer == 'pygments':
+            import pygments
+            settings.append(pygments.__version__)
+        # The author lines come out of 'git log' with the mailmap applied
+        settings.append(get_mailmap_id())
+        render_cache = RenderCache(os.path.join(git_dir, render_cache_path),
+                                   render_cache_size * 1024 * 1024, "\0".join(settings))
+    else:
+        render_cache = None
+
+    # One mailer, and so one SMTP session, for the whole push
+    if spool_dir and not debug:
+        mailer = SpoolMailer(spool_dir, *mailer_args)
+    elif mailers is not None:
+        if mailer_args not in mailers:
+            mailers[mailer_args] = Mailer(*mailer_args)
+        mailer = mailers[mailer_args]
+    else:
+        mailer = Mailer(*mailer_args)
+
+    changes = [make_change(mailer, oldrev, newrev, refname)
+               for (oldrev, newrev, refname) in updates]
+
+    for change in changes:
+        all_changes[change.refname] = change
+
+    try:
+        for change in changes:
+            start = time.time()
+            change.prepare()
+            change.timings['prepare'] = time.time() - start
+            change.send_emails()
+            processed_changes[change.refname] = change
+            tracing.change(change.refname, change.timings)
+    finally:
+        if mailers is None:
+            mailer.close()
+            # So that the cat-file processes are in the summary
+            object_reader.close()
+        elif mailer not in mailers.values():
+            # Not an SMTP session we keep
+            mailer.close()
+        # The workers know the settings of this push only
+        close_render_pool()
+        if render_cache is not None:
+            try:
+                render_cache.close()
+            except (IOError, OSError), e:
+                print >>sys.stderr, "Render cache eviction failed: %s" % e
+        tracing.summary()
+
+# How long a hook waits for the daemon to take its push
+DAEMON_REPLY_TIMEOUT = 5
+
+# Hand the push over to the daemon listening at socket_path. Returns False
+# if there is no daemon there, or it doesn't take the push in time, so that
+# we can do the work ourselves.
+def forward_to_daemon(socket_path, git_dir, updates):
+    import socket
+
+    request = os.path.abspath(git_dir) + "\n" + \
+              "".join(["%s %s %s\n" % update for update in updates])
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # A daemon that is stuck mustn't hang the push
+    sock.settimeout(DAEMON_REPLY_TIMEOUT)
+    try:
+        try:
+            sock.connect(socket_path)
+            sock.sendall(request)
+            sock.shutdown(socket.SHUT_WR)
+            reply = sock.recv(16)
+        except socket.error, e:
+            print >>sys.stderr, "Can't reach the mail daemon at %s (%s); sending mails directly" % (socket_path, e)
+            return False
+    finally:
+        sock.close()
+
+    if reply != "ok\n":
+        print >>sys.stderr, "The mail daemon at %s didn't take the push; sending mails directly" % socket_path
+        return False
+    return True
+
+# Whether 'path' looks like the absolute path of a git repository; the
+# daemon is told where to go by whoever can reach its socket
+def is_git_dir(path):
+    return (os.path.isabs(path) and
+            os.path.isfile(os.path.join(path, 'HEAD')) and
+            os.path.isdir(os.path.join(path, 'objects')) and
+            os.path.isdir(os.path.join(path, 'refs')))
+
+# How long a daemon keeps an unused SMTP session open
+SMTP_IDLE_TIMEOUT = 60
+
+# The daemon: handles the pushes that hooks forward to it over a Unix
+# socket. It saves the Python start up and imports for each push, and keeps
+# the cat-file processes of the repositories it has seen and the SMTP
+# sessions it has opened. The main thread only reads the requests and
+# replies at once, so that hooks never wait for the mails; a worker thread
+# handles the pushes one after another.
+def serve(socket_path):
+    import socket
+    import threading
+    from Queue import Queue
+
+    # Load everything we are going to need now rather than for the first push
+    import multiprocessing
+    import smtplib
+    import mailstream
+    try:
+        get_pygments()
+    except ImportError:
+        pass
+
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+
+    pushes = Queue()
+    worker = threading.Thread(target=serve_pushes, args=(pushes,))
+    worker.daemon = True
+    worker.start()
+
+    while True:
+        conn, _ = server.accept()
+        try:
+            conn.settimeout(DAEMON_REPLY_TIMEOUT)
+            request = []
+            for data in iter(lambda: conn.recv(65536), ""):
+                request.append(data)
+
+            lines = "".join(request).splitlines()
+            if not lines or not is_git_dir(lines[0]):
+                print >>sys.stderr, "Rejecting request for %r: not a git repository" % (lines[:1] or [""])[0]
+                conn.sendall("error\n")
+                continue
+
+            updates = [tuple(line.split()) for line in lines[1:] if len(line.split()) == 3]
+            pushes.put((lines[0], updates))
+            conn.sendall("ok\n")
+        except socket.error, e:
+            # The hook gives up on us, and sends the mails itself
+            print >>sys.stderr, "Reading request failed: %s" % e
+        finally:
+            conn.close()
+
+# The daemon's worker thread: handles the (git_dir, updates) pushes from
+# the queue, and closes the SMTP sessions that go unused for a while
+def serve_pushes(pushes):
+    import traceback
+    from Queue import Empty
+
+    mailers = {}
+    while True:
+        try:
+            push = pushes.get(timeout=SMTP_IDLE_TIMEOUT / 2)
+        except Empty:
+            push = None
+
+        for mailer in mailers.values():
+            if mailer.last_used is not None and time.time() - mailer.last_used > SMTP_IDLE_TIMEOUT:
+                mailer.close()
+        if push is None:
+            continue
+
+        git_dir, updates = push
+        try:
+            tracing.reset()
+            os.chdir(git_dir)
+            switch_repository(git_dir)
+            handle_push(get_repository(), updates, mailers=mailers)
+        except SystemExit:
+            # die() already said why
+            pass
+        except Exception:
+            print >>sys.stderr, "Handling push to %s failed:" % git_dir
+            traceback.print_exc()
+
+def main():
+    drain = len(sys.argv) > 1 and sys.argv[1] == '--drain'
+
+    if len(sys.argv) == 3 and sys.argv[1] == '--daemon':
+        serve(sys.argv[2])
+        return
+
+    global debug
+    if (len(sys.argv) > 1 and not drain):
+        debug = True
+        print "Debug Mode on"
+    else:
+        debug = False
+
+    updates = []
+
+    if drain:
+        pass
+    elif len(sys.argv) > 1:
         # For testing purposes, allow passing in a ref update on the command line
         if len(sys.argv) != 4:
             die("Usage: generate-commit-mail OLDREV NEWREV REFNAME")
-        changes.append(make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_user, smtp_sender_pass, use_tls,
-                                   sys.argv[1], sys.argv[2], sys.argv[3]))
+        updates.append((sys.argv[1], sys.argv[2], sys.argv[3]))
     else:
         for line in sys.stdin:
             items = line.strip().split()
             if len(items) != 3:
                 die("Input line has unexpected number of items")
-            changes.append(make_change(recipients, smtp_host, smtp_port, smtp_fallback_mail, smtp_sender, smtp_sender_user, smtp_sender_pass, use_tls,
-                                       items[0], items[1], items[2]))
+            updates.append((items[0], items[1], items[2]))
 
-    for change in changes:
-        all_changes[change.refname] = change
+    # Nothing to do; don't even look at the repository
+    if not drain and not [refname for (oldrev, newrev, refname) in updates
+                          if ref_has_email(refname)]:
+        return
 
-    for change in changes:
-        change.prepare()
-        change.send_emails()
-        processed_changes[change.refname] = change
+    # No emails for a repository in the process of being imported
+    repository = get_repository()
+    if os.path.exists(os.path.join(repository.git_dir, 'pending')):
+        return
+
+    daemon_socket = repository.get_config("hooks.daemon-socket")
+    if daemon_socket and not drain and not debug:
+        if forward_to_daemon(daemon_socket, repository.git_dir, updates):
+            return
+
+    handle_push(repository, updates, drain)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,101 @@
+# Limiting how fast the email hook sends messages
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# Relays often limit how many messages a client may send in a while, and
+# answer with a temporary failure (421, 451) beyond that. The limiter is a
+# token bucket that holds a second's worth of messages (at least one), so
+# short bursts go out at once. Whenever the server says we are too fast,
+# the rate is halved; every message that gets through raises it a little
+# again, up to the configured maximum. A big push so settles just below the
+# rate the relay takes.
+
+import collections
+import time
+
+# Never slow down to less than a message a minute
+MIN_RATE = 1 / 60.
+# How much each message sent raises the rate, in messages per second
+RATE_INCREASE = 0.05
+# The rate assumed when throttled before we know how fast we were going
+DEFAULT_RATE = 1.
+
+# Wait 1s, 2s, 4s, ... at most 5m after a failure, or longer if the server
+# asks for it
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 5*60
+
+# How many of the last messages the rate we were going at is measured over
+RECENT_MESSAGES = 20
+
+class RateLimiter(object):
+    # 'max_rate' is in messages per second; None for no limit until the
+    # server first complains
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = self._capacity()
+        self.updated = time.time()
+        # Failures since the last message that got through
+        self.failures = 0
+        self.recent = collections.deque(maxlen=RECENT_MESSAGES)
+
+    def _capacity(self):
+        if self.rate is None:
+            return 1.
+        return max(self.rate, 1.)
+
+    # Sleep until the next message may be sent
+    def wait(self):
+        if self.rate is None:
+            return
+
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self._capacity())
+        self.updated = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1.
+            self.updated = time.time()
+        self.tokens -= 1
+
+    # A message got through
+    def sent(self):
+        self.failures = 0
+        self.recent.append(time.time())
+        if self.rate is not None:
+            self.rate += RATE_INCREASE
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    # The server said we are sending too fast; 'retry_after' is how long it
+    # asked us to wait, if it did. Returns how long to wait before trying
+    # the message again.
+    def throttled(self, retry_after=None):
+        now = time.time()
+        if self.rate is None:
+            if len(self.recent) > 1 and now > self.recent[0]:
+                self.rate = (len(self.recent) - 1) / (now - self.recent[0])
+            else:
+                self.rate = DEFAULT_RATE
+        self.rate = max(self.rate / 2, MIN_RATE)
+        self.tokens = 0.
+        self.updated = now
+
+        self.failures += 1
+        delay = min(INITIAL_BACKOFF * 2 ** (self.failures - 1), MAX_BACKOFF)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, MAX_BACKOFF))
+        return delay
@@ -0,0 +1,161 @@
+# On-disk cache of the rendered bodies of commit mails
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# The body of a commit mail only depends on the commit and on how it is
+# rendered, so several repositories (forks, mirrors) can share one cache.
+# Each entry is a file named after the commit ID and a digest of the render
+# settings:
+#
+#   <dir>/ab/abcdef...-<settings digest>
+#
+# holding the zlib compressed plain text and HTML bodies. Entries are
+# written to tmp/ and renamed into place, so readers only ever see complete
+# ones and concurrent writers of the same entry don't get in each other's
+# way. The modification time of an entry is when it was last used; when the
+# cache grows past its size, the least recently used entries are removed.
+
+import errno
+import hashlib
+import os
+import socket
+import time
+import zlib
+
+# Bump when the way bodies are rendered changes
+FORMAT_VERSION = 2
+
+# After eviction the cache is at most this fraction of its size, so that
+# we don't have to evict again on the next push
+EVICT_TO = 0.8
+
+# A file left in tmp/ for this long belongs to a writer that died
+STALE_TMP_AGE = 60*60
+
+class RenderCache(object):
+    # 'settings' is a string describing everything besides the commit that
+    # goes into a body
+    def __init__(self, path, max_size, settings):
+        self.path = path
+        self.max_size = max_size
+        self.suffix = "-" + hashlib.sha1("%d\0%s" % (FORMAT_VERSION, settings)).hexdigest()[:16]
+        self.stored = 0
+        self.counter = 0
+
+    def _entry(self, commit_id):
+        return os.path.join(self.path, commit_id[:2], commit_id + self.suffix)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def contains(self, commit_id):
+        return os.path.exists(self._entry(commit_id))
+
+    # Return (body, html_body) for the commit, or None
+    def get(self, commit_id):
+        entry = self._entry(commit_id)
+        try:
+            f = open(entry, 'rb')
+            try:
+                data = zlib.decompress(f.read())
+            finally:
+                f.close()
+            # Mark it as used
+            os.utime(entry, None)
+        except (IOError, OSError, zlib.error):
+            return None
+
+        header, _, data = data.partition("\n")
+        body_length, html_length = [int(field) for field in header.split()]
+        body = data[:body_length]
+        if html_length < 0:
+            html_body = None
+        else:
+            html_body = data[body_length:body_length + html_length]
+        return body, html_body
+
+    def put(self, commit_id, body, html_body):
+        if html_body is None:
+            data = "%d -1\n%s" % (len(body), body)
+        else:
+            data = "%d %d\n%s%s" % (len(body), len(html_body), body, html_body)
+        data = zlib.compress(data, 1)
+
+        tmp_dir = os.path.join(self.path, 'tmp')
+        entry = self._entry(commit_id)
+        self._makedirs(tmp_dir)
+        self._makedirs(os.path.dirname(entry))
+
+        self.counter += 1
+        tmp_path = os.path.join(tmp_dir, "%.6f.%d_%d.%s" % (time.time(), os.getpid(), self.counter,
+                                                             socket.gethostname().replace('/', '_')))
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_path, entry)
+        self.stored += len(data)
+
+    # Remove the least recently used entries if the cache has grown too big
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for dir_name in os.listdir(self.path):
+            dir_path = os.path.join(self.path, dir_name)
+            try:
+                names = os.listdir(dir_path)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Somebody else evicted it
+                    continue
+                if dir_name == 'tmp':
+                    if now - st.st_mtime > STALE_TMP_AGE:
+                        self._unlink(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size * EVICT_TO:
+                break
+            self._unlink(path)
+            total -= size
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    # Called at the end of a push
+    def close(self):
+        if self.stored > 0:
+            self.evict()
+            self.stored = 0
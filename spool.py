@@ -0,0 +1,161 @@
+# On-disk outbox for messages generated by the email hook
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# The spool is laid out like a maildir:
+#
+#   tmp/     messages being written
+#   new/     messages waiting to be delivered
+#   cur/     messages a drainer has claimed and is delivering
+#   failed/  messages that could not be delivered
+#
+# Every move between directories is a rename(), so a message is either
+# complete or invisible, and only one of several concurrent drainers can
+# claim it. A file name is '<id>:<attempts>:<not-before>'; the id sorts in
+# the order messages were spooled, the rest is the retry state. The file
+# holds the envelope sender on the first line, the envelope recipients on
+# the second and the message itself after that.
+
+import errno
+import os
+import shutil
+import socket
+import time
+
+# Retry a failed delivery after 30s, 1m, 2m, ... at most 1h apart
+RETRY_BACKOFF = 30
+MAX_RETRY_BACKOFF = 60*60
+MAX_ATTEMPTS = 10
+
+# A message left in cur/ for this long belongs to a drainer that died
+STALE_CLAIM_AGE = 60*60
+
+class Spool(object):
+    def __init__(self, path):
+        self.path = path
+        self.counter = 0
+
+    def _dir(self, name):
+        return os.path.join(self.path, name)
+
+    def create(self):
+        for name in ('tmp', 'new', 'cur', 'failed'):
+            try:
+                os.makedirs(self._dir(name))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    # Atomically add the message read from the file 'msg_file' to new/
+    def add(self, sender, recipients, msg_file):
+        self.counter += 1
+        id = "%.6f.%d_%d.%s" % (time.time(), os.getpid(), self.counter,
+                                socket.gethostname().replace('/', '_').replace(':', '_'))
+        name = "%s:0:0" % id
+
+        tmp_path = os.path.join(self._dir('tmp'), name)
+        f = open(tmp_path, 'w')
+        try:
+            f.write(sender + "\n")
+            f.write(recipients + "\n")
+            shutil.copyfileobj(msg_file, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, os.path.join(self._dir('new'), name))
+
+    # Move messages whose drainer went away back to new/
+    def recover_stale(self):
+        now = time.time()
+        for name in os.listdir(self._dir('cur')):
+            path = os.path.join(self._dir('cur'), name)
+            try:
+                if now - os.stat(path).st_mtime > STALE_CLAIM_AGE:
+                    os.rename(path, os.path.join(self._dir('new'), name))
+            except OSError:
+                # Somebody else recovered or finished it
+                pass
+
+    # Deliver everything in new/ by calling deliver(sender, recipients, msg_file).
+    # deliver() should raise an exception for a failed delivery; permanent(e)
+    # says whether it is worth retrying. Runs until new/ is empty, sleeping
+    # when the only messages left are waiting for their retry time.
+    def drain(self, deliver, permanent, log):
+        self.recover_stale()
+
+        while True:
+            now = time.time()
+            next_attempt = None
+            worked = False
+            for name in sorted(os.listdir(self._dir('new'))):
+                try:
+                    id, attempts, not_before = name.rsplit(':', 2)
+                    attempts = int(attempts)
+                    not_before = int(not_before)
+                except ValueError:
+                    continue
+
+                if not_before > now:
+                    if next_attempt is None or not_before < next_attempt:
+                        next_attempt = not_before
+                    continue
+
+                claimed = os.path.join(self._dir('cur'), name)
+                try:
+                    os.rename(os.path.join(self._dir('new'), name), claimed)
+                except OSError:
+                    # Another drainer got there first
+                    continue
+
+                worked = True
+                # Mark when we claimed it, so it doesn't look stale to others
+                os.utime(claimed, None)
+
+                error = None
+                f = open(claimed)
+                try:
+                    sender = f.readline().rstrip("\n")
+                    recipients = f.readline().rstrip("\n")
+                    try:
+                        deliver(sender, recipients, f)
+                    except Exception, e:
+                        error = e
+                finally:
+                    f.close()
+
+                if error is not None:
+                    attempts += 1
+                    if permanent(error) or attempts >= MAX_ATTEMPTS:
+                        log("%s: giving up after %d attempt(s): %s" % (id, attempts, error))
+                        os.rename(claimed, os.path.join(self._dir('failed'), name))
+                    else:
+                        delay = min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+                        log("%s: attempt %d failed, retrying in %ds: %s" % (id, attempts, delay, error))
+                        not_before = int(time.time()) + delay
+                        os.rename(claimed, os.path.join(self._dir('new'),
+                                                        "%s:%d:%d" % (id, attempts, not_before)))
+                        if next_attempt is None or not_before < next_attempt:
+                            next_attempt = not_before
+                else:
+                    os.unlink(claimed)
+
+            if worked:
+                # Pick up anything spooled while we were busy
+                continue
+            if next_attempt is None:
+                return
+
+            time.sleep(max(next_attempt - time.time(), 1))
@@ -0,0 +1,140 @@
+# Opt-in tracing of where the email hook spends its time
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, If not, see
+# http://www.gnu.org/licenses/.
+#
+# The trace is a file of JSON records, one per line:
+#
+#   {"event": "git", "argv": [...], "duration": ..., "stdout_bytes": ..., "exit_code": ...}
+#       for every git command run
+#   {"event": "change", "ref": ..., "prepare": ..., "render": ..., "send": ...}
+#       seconds spent on each phase of handling a ref change
+#   {"event": "summary", "wall": ..., "git": {...}, "phases": {...}}
+#       totals for the whole run, written last
+#
+# Whether to trace is only known once the configuration has been read,
+# which already takes git commands; records made before enable() or
+# disable() is called are kept until then.
+
+import json
+import sys
+import time
+
+_out = None
+_decided = False
+_pending = []
+
+_start = time.time()
+# git command => [count, seconds, stdout bytes]
+_git_totals = {}
+# phase => seconds
+_phase_totals = {}
+
+# Start over for another run (in the daemon)
+def reset():
+    global _out, _decided, _pending, _start, _git_totals, _phase_totals
+    _out = None
+    _decided = False
+    _pending = []
+    _start = time.time()
+    _git_totals = {}
+    _phase_totals = {}
+
+def _write(record):
+    if _out is not None:
+        _out.write(json.dumps(record) + "\n")
+        _out.flush()
+    elif not _decided:
+        _pending.append(record)
+
+def _active():
+    return _out is not None or not _decided
+
+# Start writing the trace to the file at 'path' (appending to it)
+def enable(path):
+    global _out, _decided, _pending
+    try:
+        _out = open(path, 'a')
+    except IOError, e:
+        print >>sys.stderr, "Can't write trace to %s: %s" % (path, e)
+        disable()
+        return
+    _decided = True
+    for record in _pending:
+        _write(record)
+    _pending = []
+
+def disable():
+    global _decided, _pending
+    _decided = True
+    _pending = []
+
+def git_command(argv, duration, stdout_bytes, exit_code, **extra):
+    if not _active():
+        return
+
+    totals = _git_totals.setdefault(argv[1], [0, 0., 0])
+    totals[0] += 1
+    totals[1] += duration
+    totals[2] += stdout_bytes
+
+    record = {
+        'event': 'git',
+        'argv': argv,
+        'duration': round(duration, 6),
+        'stdout_bytes': stdout_bytes,
+        'exit_code': exit_code
+    }
+    record.update(extra)
+    _write(record)
+
+# 'timings' maps phase name => seconds
+def change(refname, timings):
+    if not _active():
+        return
+
+    for phase, duration in timings.iteritems():
+        _phase_totals[phase] = _phase_totals.get(phase, 0.) + duration
+
+    record = {'event': 'change', 'ref': refname}
+    for phase, duration in timings.iteritems():
+        record[phase] = round(duration, 6)
+    _write(record)
+
+def summary():
+    global _out
+    if _out is None:
+        return
+
+    commands = {}
+    for command, (count, duration, stdout_bytes) in _git_totals.iteritems():
+        commands[command] = {
+            'count': count,
+            'duration': round(duration, 6),
+            'stdout_bytes': stdout_bytes
+        }
+
+    _write({
+        'event': 'summary',
+        'wall': round(time.time() - _start, 6),
+        'git': {
+            'count': sum([totals[0] for totals in _git_totals.itervalues()]),
+            'duration': round(sum([totals[1] for totals in _git_totals.itervalues()]), 6),
+            'stdout_bytes': sum([totals[2] for totals in _git_totals.itervalues()]),
+            'commands': commands
+        },
+        'phases': dict([(phase, round(duration, 6)) for phase, duration in _phase_totals.iteritems()])
+    })
+    _out.close()
+    _out = None
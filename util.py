@@ -20,7 +20,6 @@
 import os
 import sys
 from subprocess import Popen
-import tempfile
 import time
 
 def die(message):